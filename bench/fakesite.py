@@ -0,0 +1,320 @@
+""" Local stand-in of the facebook pages used by the tasks """
+
+import json
+import re
+import time
+from multiprocessing import Process, Queue
+from threading import Lock
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+try:
+    from urllib.parse import parse_qs, urlsplit
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+    from urlparse import parse_qs, urlsplit
+
+LOGIN_PAGE = """<!DOCTYPE html>
+<html><head><title>Log In</title></head><body>
+<div id="content">
+  <form id="login_form" method="post" action="/login.php">
+    <input type="text" name="email">
+    <input type="password" name="pass">
+    <input type="submit" value="Log In">
+  </form>
+</div>
+</body></html>
+"""
+
+HOME_PAGE = """<!DOCTYPE html>
+<html><head><title>Home</title></head><body>
+<div id="content">
+  <div data-click="profile_icon"><a href="/me">Profile</a></div>
+</div>
+</body></html>
+"""
+
+MEMBER_HTML = """
+    <div id="member_%(id)d" class="fbProfileBrowserListItem">
+      <a class="name" href="/profile.php?id=%(id)d">Member %(id)d</a>
+      <div class="adminActions">
+        <a href="#" ajaxify="/ajax/groups/membership/remove_block.php?member_id=%(id)d&amp;action=remove_block">Remove Block</a>
+      </div>
+    </div>"""
+
+MORE_PAGER_HTML = """
+    <div class="uiMorePager"><a class="uiMorePagerPrimary" href="#" data-after="%d">See More</a></div>"""
+
+NULLSTATE_HTML = """
+    <div class="fbProfileBrowserNullstate fbProfileBrowserListContainer">No blocked members.</div>"""
+
+BLOCKED_PAGE = """<!DOCTYPE html>
+<html><head><title>Blocked</title></head><body>
+<div id="content">
+  <div id="pagelet_group_blocked">%(members)s
+  </div>
+</div>
+<script>
+(function() {
+    var list = document.getElementById('pagelet_group_blocked');
+    var dialog = null;
+
+    function request(url, callback) {
+        var xhr = new XMLHttpRequest();
+        xhr.open('POST', url, true);
+        xhr.onreadystatechange = function() {
+            if (xhr.readyState == 4) {
+                callback(xhr);
+            }
+        };
+        xhr.send('');
+    }
+
+    function closeDialog() {
+        if (dialog) {
+            dialog.parentNode.removeChild(dialog);
+            dialog = null;
+        }
+    }
+
+    function showNullstate() {
+        if (list.querySelector('div[id^="member_"]') ||
+                list.querySelector('.uiMorePager')) {
+            return;
+        }
+        list.innerHTML = '%(nullstate)s';
+    }
+
+    document.addEventListener('click', function(evt) {
+        var el = evt.target;
+        if (el.getAttribute('ajaxify')) {
+            evt.preventDefault();
+            closeDialog();
+            dialog = document.createElement('div');
+            dialog.className = 'uiLayer';
+            dialog.innerHTML = '<button name="remove_block">Confirm</button>';
+            dialog.firstChild.setAttribute('data-ajaxify',
+                    el.getAttribute('ajaxify'));
+            document.body.appendChild(dialog);
+        }
+        else if (el.name == 'remove_block') {
+            var url = el.getAttribute('data-ajaxify');
+            var member = /member_id=(\\d+)/.exec(url)[1];
+            closeDialog();
+            request(url, function(xhr) {
+                if (xhr.status == 200) {
+                    var item = document.getElementById('member_' + member);
+                    if (item) {
+                        item.parentNode.removeChild(item);
+                    }
+                }
+                showNullstate();
+            });
+        }
+        else if (el.className == 'uiMorePagerPrimary') {
+            evt.preventDefault();
+            var pager = el.parentNode;
+            request('/ajax/groups/blocked_more.php?after=' +
+                    el.getAttribute('data-after'), function(xhr) {
+                pager.parentNode.removeChild(pager);
+                var holder = document.createElement('div');
+                holder.innerHTML = xhr.responseText;
+                while (holder.firstChild) {
+                    list.appendChild(holder.firstChild);
+                }
+                showNullstate();
+            });
+        }
+    }, false);
+})();
+</script>
+</body></html>
+"""
+
+
+class FakeSiteState(object):
+    """ Blocked members of the fake group, shared by the request threads """
+    def __init__(self, members, page_size):
+        self.lock = Lock()
+        self.members = list(range(1, members + 1))
+        self.page_size = page_size
+        self.removed = []
+        self.requests = 0
+
+
+    def render_members(self, after):
+        """ A page of members listed after a member id """
+        with self.lock:
+            members = [x for x in self.members if x > after]
+
+        html = ''.join(MEMBER_HTML % {'id': member} for member in \
+                members[:self.page_size])
+
+        if len(members) > self.page_size:
+            html += MORE_PAGER_HTML % members[self.page_size - 1]
+        return html
+
+
+    def remove(self, member):
+        with self.lock:
+            if not member in self.members:
+                return False
+            self.members.remove(member)
+            self.removed.append(member)
+            return True
+
+
+class FakeSiteHandler(BaseHTTPRequestHandler):
+    """
+    Serves requests of a browser using this server as its http proxy, so
+    the pages keep their www.facebook.com urls.
+    """
+    protocol_version = 'HTTP/1.0'
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        self.dispatch('POST', parse_qs(body))
+
+
+    def dispatch(self, method, form=None):
+        server = self.server
+        with server.state.lock:
+            server.state.requests += 1
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        scheme, netloc, path, query, segment = urlsplit(self.path)
+        logged_in = 'c_user=' in (self.headers.get('Cookie') or '')
+
+        if path == '/__bench/stats':
+            state = server.state
+            with state.lock:
+                stats = {'requests': state.requests,
+                        'removed': len(state.removed),
+                        'remaining': len(state.members)}
+            self.respond(200, json.dumps(stats), 'application/json')
+
+        elif path == '/__bench/stop':
+            self.respond(200, 'bye')
+            server.stopping = True
+
+        elif path == '/login.php' and method == 'POST':
+            if form.get('email') and form.get('pass'):
+                self.respond(302, '', headers=[
+                        ('Location', '/'),
+                        ('Set-Cookie', 'c_user=1; path=/'),
+                        ('Set-Cookie', 'xs=bench; path=/')])
+            else:
+                self.respond(302, '', headers=[('Location', '/login.php')])
+
+        elif path in ('/', '/login.php'):
+            if logged_in and path == '/':
+                self.respond(200, HOME_PAGE)
+            else:
+                self.respond(200, LOGIN_PAGE)
+
+        elif re.match(r'^/groups/[^/]+/blocked/?$', path):
+            if not logged_in:
+                self.respond(302, '', headers=[('Location',
+                        '/login.php?next=' + path)])
+                return
+
+            members = server.state.render_members(0) or NULLSTATE_HTML
+            self.respond(200, BLOCKED_PAGE % {'members': members,
+                    'nullstate': NULLSTATE_HTML.strip().replace("'", "\\'")})
+
+        elif path == '/ajax/groups/membership/remove_block.php':
+            member = int(parse_qs(query).get('member_id', ['0'])[0])
+            if server.state.remove(member):
+                self.respond(200, '{"ok": true}', 'application/json')
+            else:
+                self.respond(404, '{"ok": false}', 'application/json')
+
+        elif path == '/ajax/groups/blocked_more.php':
+            after = int(parse_qs(query).get('after', ['0'])[0])
+            self.respond(200, server.state.render_members(after))
+
+        else:
+            self.respond(404, 'Not found')
+
+
+    def respond(self, status, body, content_type='text/html', headers=()):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeSiteServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    stopping = False
+
+
+def _serve(members, page_size, latency, port_queue):
+    server = FakeSiteServer(('127.0.0.1', 0), FakeSiteHandler)
+    server.state = FakeSiteState(members, page_size)
+    server.latency = latency
+    # wake up regularly to notice the stop request
+    server.timeout = 0.5
+    port_queue.put(server.server_address[1])
+
+    while not server.stopping:
+        server.handle_request()
+
+
+class FakeSite(object):
+    """
+    Runs the fake site in its own process, so it doesn't count against the
+    measured cpu time and memory.
+    """
+    port = None
+    _process = None
+
+    def __init__(self, members=20, page_size=50, latency=0.0):
+        self.members = members
+        self.page_size = page_size
+        self.latency = latency
+
+
+    def start(self):
+        port_queue = Queue()
+        self._process = Process(target=_serve, args=(self.members,
+                self.page_size, self.latency, port_queue))
+
+        self._process.daemon = True
+        self._process.start()
+        self.port = port_queue.get(timeout=10)
+        return self.port
+
+
+    def stats(self):
+        response = urlopen('http://127.0.0.1:%d/__bench/stats' % self.port)
+        return json.loads(response.read().decode('utf-8'))
+
+
+    def stop(self):
+        try:
+            urlopen('http://127.0.0.1:%d/__bench/stop' % self.port).read()
+        except IOError:
+            pass
+        self._process.join(5)
+        if self._process.is_alive():
+            self._process.terminate()
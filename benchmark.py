@@ -0,0 +1,154 @@
+""" Run a task against the local fake site and report its performance """
+
+import json
+import resource
+import signal
+import sys
+from optparse import OptionParser
+try:
+    from time import monotonic as timer
+except ImportError:
+    from time import time as timer
+
+from bench.fakesite import FakeSite
+from core.reporter import Reporter
+from tasks import get_task
+
+app = None
+
+def signal_handler(signum, frame):
+    if app:
+        app.exit(-1)
+
+signal.signal(signal.SIGINT, signal_handler)
+signal.signal(signal.SIGTERM, signal_handler)
+
+
+def get_bench_settings(port, options):
+    """ Settings of the task pointing to the fake site """
+    settings = {
+        'application.journal.filename': '',
+        'application.network.cache.directory': '',
+        'application.network.cookies.filename': '',
+        'application.network.proxy': '127.0.0.1:%d' % port,
+        'application.visible': '0',
+        'facebook.forum.name': 'bench',
+        'facebook.home': 'http://www.facebook.com',
+        'facebook.password': 'bench',
+        'facebook.username': 'bench@example.com',
+    }
+    for logname in Reporter.known_logs:
+        settings['reporter.%s.type' % logname] = 'console'
+        settings['reporter.%s.log_level' % logname] = options.log_level
+
+    return settings
+
+
+class TransitionRecorder(object):
+    """ Collects the fulfilled expectations of an application """
+    def __init__(self, app):
+        self.started = timer()
+        self.transitions = []
+        self.page_loads = 0
+
+        app.transition.connect(self._on_transition)
+        for context in app.contexts:
+            context.web_page.loadFinished.connect(self._on_page_loaded)
+
+
+    def _on_transition(self, trigger, latency):
+        self.transitions.append({
+            'trigger': str(trigger),
+            'latency': latency,
+            'at': timer() - self.started,
+        })
+
+
+    def _on_page_loaded(self, success):
+        self.page_loads += 1
+
+
+    def summary(self):
+        result = {}
+        for item in self.transitions:
+            stats = result.setdefault(item['trigger'], {'count': 0,
+                    'total': 0.0, 'max': 0.0})
+
+            stats['count'] += 1
+            stats['total'] += item['latency']
+            stats['max'] = max(stats['max'], item['latency'])
+        return result
+
+
+def run_benchmark(task_name, options):
+    global app
+    from core.application import Application
+
+    collect_settings, build_queue = get_task(task_name)
+
+    site = FakeSite(members=options.members, page_size=options.page_size,
+            latency=options.latency / 1000.0)
+
+    port = site.start()
+    try:
+        settings = {}
+        collect_settings(settings, get_bench_settings(port, options))
+
+        app = Application('bench', settings)
+        Reporter('bench', settings).attach(app)
+        recorder = TransitionRecorder(app)
+        build_queue(app)
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        started = timer()
+        exit_code = app.start()
+        total_time = timer() - started
+        usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+        site_stats = site.stats()
+    finally:
+        site.stop()
+
+    return {
+        'task': task_name,
+        'exit_code': exit_code,
+        'members': options.members,
+        'total_time': total_time,
+        'cpu_time': (usage_after.ru_utime - usage.ru_utime) + \
+                (usage_after.ru_stime - usage.ru_stime),
+
+        # kilobytes on linux
+        'peak_rss': usage_after.ru_maxrss,
+        'page_loads': recorder.page_loads,
+        'transitions': recorder.transitions,
+        'transition_summary': recorder.summary(),
+        'site': site_stats,
+    }
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [options] TASK')
+    parser.add_option('--members', type='int', default=20,
+            help='blocked members on the fake site')
+    parser.add_option('--page-size', type='int', default=50,
+            help='members listed before "see more"')
+    parser.add_option('--latency', type='float', default=0.0,
+            help='fake site response delay (milliseconds)')
+    parser.add_option('--log-level', default='error',
+            help='log verbosity of the task (debug, info, warning, error)')
+    parser.add_option('--output', metavar='FILE',
+            help='write the JSON results to a file instead of stdout')
+
+    options, args = parser.parse_args()
+    if len(args) != 1 or get_task(args[0])[0] is None:
+        parser.error('Expected a task name.')
+
+    result = run_benchmark(args[0], options)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(result, f, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    exit(result['exit_code'])
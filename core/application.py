@@ -1,21 +1,12 @@
 """ Shared Application """
 
 import os
-import re
-from collections import OrderedDict
 from functools import partial
-from logging import DEBUG, ERROR, INFO, WARNING
-from threading import Lock
-from uuid import uuid4
+from logging import DEBUG, ERROR, INFO, WARNING, getLogger
 try:
-    from queue import Empty, Queue
+    from time import monotonic as timer
 except ImportError:
-    from Queue import Empty, Queue
-try:
-    # python2.6 support
-    from simplejson import load as json_load
-except ImportError:
-    from json import load as json_load
+    from time import time as timer
 try:
     from urllib.parse import urlsplit
 except ImportError:
@@ -23,39 +14,71 @@ except ImportError:
 try:
     from PyQt5.QtWidgets import QApplication
     from PyQt5.QtCore import QUrl, QTimer, pyqtSignal, qInstallMessageHandler
-    from PyQt5.QtWebKitWidgets import QWebPage, QWebView
+    from PyQt5.QtWebKit import QWebSettings
+    from PyQt5.QtWebKitWidgets import QWebPage
     from PyQt5.QtNetwork import QNetworkReply, QNetworkRequest
 except ImportError:
     from PyQt4.QtGui import QApplication
     from PyQt4.QtCore import QUrl, QTimer, pyqtSignal
     from PyQt4.QtCore import qInstallMsgHandler
-    from PyQt4.QtWebKit import QWebPage, QWebView
+    from PyQt4.QtWebKit import QWebPage, QWebSettings
     from PyQt4.QtNetwork import QNetworkReply, QNetworkRequest
 
-from core.helpers import flatten_settings_definition, make_list
-from core.webpage import WebPage
-
-ENUM_FRAME_DATA_ACTIVE = 0
-ENUM_FRAME_DATA_TIMER_CALLBACK = 1
-ENUM_FRAME_DATA_TIMER_COUNTER = 2
+from core.archive import ARCHIVE_MODES, NetworkArchive
+from core.expects import EXPECT_FIELDS, EXPECTS_ENGINES, ExpectationIndex
+from core.expects import TRIGGER_DELAY_MODES, is_element_ready
+from core.expects import probe_selectors
+from core.feeds import create_feeds
+from core.frames import FrameRegistry
+from core.helpers import format_size, get_rss, load_settings_definition
+from core.helpers import make_list
+from core.journal import Journal
+from core.metrics import PhaseHistogram, Timeline, TriggerDelays
+from core.network import BlockRules, CookieJar, DiskCache
+from core.pagecontext import PageContext
+from core.scheduler import Scheduler
+from core.scripts import ScriptLibrary
+from core.watcher import DomWatcher
+
+MAX_TASK_RETRIES = 3
 
 
 class Application(QApplication):
-    _active_task = None
+    _archive = None
+    _block_rules = None
+    _context = None
+    _contexts = None
+    _daemon = False
+    _delay_mode = 'fixed'
+    _done = None
+    _dom_watcher = None
+    _event_driven = True
+    _event_frames = None
+    _event_timer = None
     _exit_timer = None
-    _expects = None
-    _expects_active = False
-    _expects_if_timeout = None
-    _expects_timer = None
-    _frame_data = None
-    _frame_data_lock = None
+    _feeds = None
     _frame_timer = None
+    _frames = None
     _handlers = None
+    _journal = None
+    _max_pages = 0
+    _max_rss = 0
+    _network_idle = 0
+    _phase_histogram = None
     _queue = None
-    _trigger_delay_timer = None
+    _queue_timer = None
+    _scripted = False
+    _scripts = None
+    _started_at = None
+    _stopping = False
+    _transitions = None
+    _trigger_delays = None
     _visible = True
 
+    cookie_jar = None
     log_event = pyqtSignal(int, str, str)
+    # emitted with trigger name and seconds spent waiting for the expectation
+    transition = pyqtSignal(str, float)
     name = ''
 
     def __init__(self, name, settings):
@@ -64,47 +87,83 @@ class Application(QApplication):
         self.name = name
         self.settings = settings
 
-        self.web_view = QWebView()
-
         self._exit_timer = QTimer(self)
         self._exit_timer.setSingleShot(True)
         self._exit_timer.setInterval(1000)
 
-        self._expects = []
-        self._expects_if_timeout = []
-        self._expects_timer = QTimer(self)
-        self._expects_timer.setSingleShot(True)
-        self._expects_timer.timeout.connect(self._on_expects_timeout)
-        self._frame_data = {}
-        self._frame_data_lock = Lock()
+        self._frames = FrameRegistry(int(
+                self.settings['application.frames.leak_threshold']))
+
         self._frame_timer = QTimer(self)
-        self._frame_timer.start(3000)
-        self._queue = Queue()
-        self._trigger_delay_timer = QTimer(self)
-        self._trigger_delay_timer.setSingleShot(True)
+        self._frame_timer.timeout.connect(self._on_frame_timer)
+        self._frame_timer.start(int(
+                self.settings['application.expects.poll_interval']))
+
+        self._event_driven = self.settings['application.expects.mode'] == \
+                'event'
+
+        self._event_frames = set()
+        self._event_timer = QTimer(self)
+        self._event_timer.setSingleShot(True)
+        self._event_timer.setInterval(int(
+                self.settings['application.expects.event_delay']))
+
+        self._event_timer.timeout.connect(self._on_event_timer)
+
+        engine = self.settings['application.expects.engine']
+        if not engine in EXPECTS_ENGINES:
+            self.warn('"%s" is not a valid expectations engine.' % engine)
+        self._scripted = engine == 'javascript'
+
+        self._dom_watcher = DomWatcher(self)
+        if self._event_driven:
+            self._dom_watcher.mutated.connect(self._on_dom_mutated)
+
+        self._delay_mode = self.settings['application.trigger.delay_mode']
+        self._network_idle = int(
+                self.settings['application.trigger.network_idle'])
+
+        self._trigger_delays = TriggerDelays()
+
+        archive_mode = self.settings['application.network.archive.mode']
+        if not archive_mode in ARCHIVE_MODES:
+            self.warn('"%s" is not a valid archive mode.' % archive_mode)
+            self.settings['application.network.archive.mode'] = ''
+        self._archive = NetworkArchive.from_settings(self.settings, self.name)
+
+        self._block_rules = BlockRules.from_settings(self.settings)
+        self.cookie_jar = CookieJar.from_settings(self.settings, self.name,
+                self)
+
+        self._daemon = bool(int(self.settings['application.daemon.enabled']))
+        self._max_pages = int(self.settings['application.daemon.max_pages'])
+        self._max_rss = int(self.settings['application.daemon.max_rss']) * \
+                1024 * 1024
+
+        # dispatches the queued tasks once they can be started
+        self._queue_timer = QTimer(self)
+        self._queue_timer.setSingleShot(True)
+        self._queue_timer.timeout.connect(self.process_next_queue)
+
+        self._done = set()
+        self._journal = Journal.from_settings(self.settings, self.name)
+        self._phase_histogram = PhaseHistogram()
+        self._scripts = ScriptLibrary()
+        self._scripts.add_file('bot', 'bot.js')
+        self._queue = Scheduler.from_settings(self.settings)
+        self._transitions = 0
         self._visible = int(self.settings['application.visible'])
 
-        self.web_page = WebPage(self.web_view)
-        self.web_page.log_event.connect(self.log_event)
-        self.web_page.frameCreated.connect(self._on_frame_created)
-        self._on_frame_created(self.web_page.mainFrame())
-        #self.web_page.networkAccessManager().finished.connect(
-        #        self._on_http_response)
-
-        self.web_view.setPage(self.web_page)
+        self.clear_handlers()
 
-        st = self.web_page.settings()
-        st.setAttribute(
-            st.AutoLoadImages,
-            int(self.settings['application.settings.load_images']))
-        st.setAttribute(
-            st.JavaEnabled,
-            int(self.settings['application.settings.java_enabled']))
-        st.setAttribute(
-            st.PluginsEnabled,
-            int(self.settings['application.settings.plugins_enabled']))
+        # tasks fed from outside keep the application running
+        self._feeds = create_feeds(self)
+        if self._feeds:
+            self._daemon = True
 
-        self.clear_handlers()
+        self._contexts = []
+        for index in range(max(1, int(self.settings['application.pool_size']))):
+            self._contexts.append(self._create_context(index))
 
         # redirect qt related messages
         try:
@@ -113,53 +172,168 @@ class Application(QApplication):
             qInstallMsgHandler(self._pyqt4_null_message_handler)
 
 
+    @property
+    def contexts(self):
+        """ Pages of the pool """
+        return tuple(self._contexts)
+
+
+    @property
+    def web_page(self):
+        return (self._context or self._contexts[0]).web_page
+
+
+    @property
+    def web_view(self):
+        return (self._context or self._contexts[0]).web_view
+
+
     def start(self):
+        self._started_at = timer()
+        for feed in self._feeds:
+            feed.start()
         self.process_next_queue()
         if self._visible:
-            self.web_view.show()
+            for context in self._contexts:
+                context.web_view.show()
         return self.exec_()
 
 
     def add_queue(self, task, publish=False):
-        self._queue.put(task)
+        """
+        Queue a task, besides `goto` and `expects` it may have a `priority`
+        (higher first), a `delay` (seconds before it can be started) and
+        `handlers` registered on the page running it.
+        """
+        task_id = None
+        if self._journal is not None:
+            task_id = self._journal.add_task(task)
+            if task_id is None:
+                self.warn('Task cannot be saved in the journal: %s.' % \
+                        task.get('goto'))
 
+        self._queue.put(task, task_id)
+        if self._started_at is not None and not self._stopping:
+            # idle pages may take it
+            self._queue_timer.start(0)
 
-    def process_next_queue(self):
-        self._on_next_queue_trigger(self)
 
+    def reset_journal(self):
+        """ Start a new run, the previous one can't be resumed anymore """
+        if self._journal is not None:
+            self._journal.reset()
 
-    def get_frame_related_data(self, frame):
+
+    def resume(self):
         """
-        There is a pool of reusable frame data, because browser's frames were
-        easily created and destroyed.
+        Queue the unfinished tasks and register the handlers of the previous
+        run, returns the number of tasks.
         """
-        with self._frame_data_lock:
-            frame_data = self._frame_data.get(str(frame.objectName()))
-        return frame_data
+        if self._journal is None:
+            return 0
+
+        for name, callback in self._journal.handlers():
+            self._handlers[name] = callback
+
+        tasks = self._journal.tasks()
+        for task_id, task in tasks:
+            self._queue.put(task, task_id)
+
+        if tasks:
+            self.info('Resuming %d unfinished tasks.' % len(tasks))
+        return len(tasks)
+
+
+    def mark_done(self, key):
+        """ Remember a completed item, it survives a resume """
+        self._done.add(key)
+        if self._journal is not None:
+            self._journal.mark_done(key)
+
+
+    def is_done(self, key):
+        if key in self._done:
+            return True
+        return self._journal is not None and self._journal.is_done(key)
+
+
+    def process_next_queue(self):
+        """ Hand queued tasks to every idle page """
+        if self._stopping:
+            return
+
+        for context in self._contexts:
+            if context.idle and not self._start_next_task(context):
+                break
+
+
+    def get_frame_related_data(self, frame):
+        """ `FrameRecord` of a frame, None if it was destroyed """
+        return self._frames.get_frame(frame)
 
 
     def set_expects(self, expects):
-        self._expects_active = True
+        """ Set expectations of the page currently being handled """
+        context = self._context or self._contexts[0]
+        context.expects_active = True
 
         newlist = make_list(expects)
         for item in newlist:
             for key in item:
-                if not key in ('path', 'hash', 'host', 'selector_exists',
-                        'selector_not_exists', 'trigger', 'trigger_args',
-                        'trigger_delay', 'trigger_wait_pageload', 'custom'):
-
+                if not key in EXPECT_FIELDS:
                     self.warn('"%s" is not a valid expect field.' % key)
 
-            item['selector_exists'] = make_list(item.get('selector_exists'))
-            item['selector_not_exists'] = make_list(
-                    item.get('selector_not_exists'))
+            delay_mode = item.get('trigger_delay_mode')
+            if delay_mode is not None and \
+                    not delay_mode in TRIGGER_DELAY_MODES:
+
+                self.warn('"%s" is not a valid trigger delay mode.' % \
+                        delay_mode)
+
+        context.expects = ExpectationIndex(newlist, self._scripted,
+                self._delay_mode)
 
-        self._expects = newlist
+        context.expects_generation += 1
+        context.expects_since = timer()
+        context.timeline = Timeline(context.index)
+
+        context.proxy.set_expects(context.expects)
+        if context.expects.scripted:
+            for record in self._frames.of_context(context):
+                if record.active:
+                    context.proxy.notify(record.frame)
+
+        if self._event_driven:
+            # the page may already be in the expected state
+            self._event_frames.update(record.name for record in \
+                    self._frames.of_context(context))
+
+            self._event_timer.start()
 
 
     def set_timeout_expects(self, timeout, expects):
-        self._expects_timer.start(timeout * 1000)
-        self._expects_if_timeout = make_list(expects)
+        context = self._context or self._contexts[0]
+        context.expects_timer.start(int(timeout * 1000))
+        context.expects_if_timeout = make_list(expects)
+
+
+    def clear_timeout_expects(self):
+        context = self._context or self._contexts[0]
+        context.expects_timer.stop()
+        context.expects_if_timeout = []
+
+
+    def add_script(self, name, filename):
+        """
+        Javascript installed with the `bot` helpers in the frames handlers
+        were called for, relative filenames are in `core/js`.
+        """
+        self._scripts.add_file(name, filename)
+
+
+    def install_scripts(self, frame):
+        """ For handlers working on another frame than the one given """
+        self._scripts.install(frame)
 
 
     def set_upload_files(self, filenames):
@@ -167,119 +341,360 @@ class Application(QApplication):
 
 
     def add_handler(self, name, value):
-        self._handlers[name] = value
+        """
+        Handlers registered before the application started were shared by all
+        pages, afterwards they belong to the page currently being handled.
+        """
+        if self._context is None:
+            self._handlers[name] = value
+            if self._journal is not None and \
+                    not self._journal.set_handler(name, value):
+
+                self.warn('Handler %s cannot be restored on resume.' % name)
+        else:
+            self._context.handlers[name] = value
 
 
     def clear_handlers(self):
         # clear handlers registration
-        self._handlers = {
+        handlers = {
             'core.next_queue': self._on_next_queue_trigger,
-            'core.page_not_found': self._on_page_not_found_trigger}
+            'core.page_not_found': self._on_page_not_found_trigger,
+            'core.retry_task': self._on_retry_task_trigger}
+
+        if self._context is None:
+            self._handlers = handlers
+        else:
+            self._context.handlers = handlers
 
 
     def load(self, url):
         self.web_view.load(QUrl(url))
 
 
-    def info(self, message):
-        self.log_event.emit(INFO, message, 'default')
+    def is_logging(self, log_level, group='default'):
+        """
+        Whether a message would be logged, used to skip building expensive
+        debug messages.
+        """
+        return getLogger(group).isEnabledFor(log_level)
+
+
+    def log(self, log_level, message, *args, **kwargs):
+        """
+        Messages below the level of the log were dropped before `args` were
+        formatted into them or any signal was emitted.
+        """
+        group = kwargs.get('group', 'default')
+        if self.is_logging(log_level, group):
+            if args:
+                message = message % args
+            self.log_event.emit(log_level, message, group)
+
+    def info(self, message, *args):
+        self.log(INFO, message, *args)
 
-    def debug(self, message):
-        self.log_event.emit(DEBUG, message, 'default')
+    def debug(self, message, *args):
+        self.log(DEBUG, message, *args)
 
-    def error(self, message):
-        self.log_event.emit(ERROR, message, 'default')
+    def error(self, message, *args):
+        self.log(ERROR, message, *args)
 
-    def warn(self, message):
-        self.log_event.emit(WARNING, message, 'default')
+    def warn(self, message, *args):
+        self.log(WARNING, message, *args)
 
 
     def exit(self, return_code):
-        self.web_view.hide()
-        self._expects_active = False
-        self.web_view.stop()
+        self._stopping = True
+        for feed in self._feeds:
+            feed.stop()
+
+        if self._started_at is not None:
+            self.info('Finished after %.3fs, %d transitions.' % (
+                    timer() - self._started_at, self._transitions))
+
+        summary = self._phase_histogram.summary()
+        if summary:
+            self.info('Phase durations:\n' + '\n'.join(summary))
+
+        summary = self._trigger_delays.summary()
+        if summary:
+            self.info('Trigger delays:\n' + '\n'.join(summary))
+
+        if self.cookie_jar is not None:
+            self.cookie_jar.save()
+
+        self.info(self._frames.describe())
+
+        if self._archive is not None:
+            # the last responses were written on close
+            self._archive.close()
+            self.log_event.emit(INFO, self._archive.describe(), 'http')
+
+        if self._journal is not None:
+            if return_code == 0 and not len(self._queue) and \
+                    all(x.idle for x in self._contexts):
+
+                # nothing left to resume
+                self._journal.reset()
+            self._journal.close()
+            self._journal = None
+
+        for context in self._contexts:
+            context.network.report_cache()
+            self.log_event.emit(INFO, 'Page #%d: %d loads in %.3fs.' % (
+                    context.index, context.loads, context.load_time), 'http')
+
+            context.web_view.hide()
+            context.expects_active = False
+            context.proxy.stop()
+            context.ready_timer.stop()
+            context.web_view.stop()
+        self._queue_timer.stop()
         self._exit_timer.timeout.connect(partial(
                 super(Application, self).exit, return_code))
 
         self._exit_timer.start(1000)
 
 
-    def _url_matched_expectation(self, expect, scheme, netloc, path, query,
-            segment):
+    def _url_matched_expectations(self, scheme, netloc, path, query, segment,
+            debug=False):
 
-        if 'host' in expect and not re.match(expect['host'], netloc):
-            self.debug('%s location.host: "%s" "%s"' % (expect['trigger'],
-                    expect['host'], netloc))
-            return False
+        expects = self._context.expects
+        matched = expects.match_url(netloc, path, segment)
+        if debug and len(matched) < len(expects.unscripted):
+            # the scripted ones were left to the page script
+            for expect in expects.unscripted:
+                if expect in matched:
+                    continue
+                message = expect.describe_mismatch(netloc, path, segment)
+                if message is not None:
+                    self.debug(message)
 
-        if 'path' in expect and not re.match(expect['path'], path):
-            self.debug('%s location.pathname: "%s" "%s"' % (expect['trigger'],
-                    expect['path'], path))
-            return False
+        return matched
 
-        if 'hash' in expect and not re.match(expect['hash'], segment):
-            self.debug('%s location.hash: "%s" "%s"' % (expect['trigger'],
-                    expect['hash'], segment))
-            return False
 
-        return True 
+    def probe_selectors(self, frame, expects):
+        """
+        Which selectors of the expectations exist in the frame, evaluated in a
+        single javascript call. The results were kept until the frame's
+        document changed, if the frame is being watched for mutations.
+        """
+        record = self._frames.get_frame(frame)
+        if record is None or not record.watched:
+            probe = {}
+        else:
+            probe = record.probe
 
+        missing = []
+        for expect in expects:
+            for selector in expect.selectors:
+                if not selector in probe and not selector in missing:
+                    missing.append(selector)
+
+        probe.update(probe_selectors(frame, missing))
+        return probe
 
-    def process_expectations(self, expect, frame, urlparts):
-        if not self._url_matched_expectation(expect, *urlparts):
-            return
 
-        document = frame.documentElement()
+    def process_expectations(self, expect, frame, urlparts, debug=False,
+            probe=None):
 
-        for selector in expect.get('selector_exists', []):
-            if document.findFirst(selector).isNull():
-                self.debug('%s selector_exists: %s' % (expect['trigger'],
-                        selector))
+        """ Process an expectation whose url patterns were matched """
+        if probe is None:
+            probe = self.probe_selectors(frame, [expect])
+
+        for selector in expect.selector_exists:
+            if not probe[selector]:
+                if debug:
+                    self.debug('%s selector_exists: %s' % (expect.trigger,
+                            selector))
                 return
 
-        for selector in expect.get('selector_not_exists', []):
-            if not document.findFirst(selector).isNull():
-                self.debug('%s selector_not_exists: %s' % (expect['trigger'],
-                        selector))
+        for selector in expect.selector_not_exists:
+            if probe[selector]:
+                if debug:
+                    self.debug('%s selector_not_exists: %s' % (
+                            expect.trigger, selector))
                 return
 
-        if 'custom' in expect and not expect['custom'](self, frame, *urlparts):
+        context = self._context
+        frame_name = str(frame.objectName())
+        if expect.network_idle is not None and \
+                context.network.idle_time(frame_name) * 1000 < \
+                expect.network_idle:
+
+            if debug:
+                self.debug('%s network_idle: %d' % (expect.trigger,
+                        expect.network_idle))
             return
 
-        self.debug('%s triggered.' % expect['trigger'])
-        self._expects_active = False
+        if expect.xhr_url is not None and not expect.match_request(
+                context.requests, frame_name, context.expects_since):
+
+            if debug:
+                self.debug('%s xhr_url: %s' % (expect.trigger,
+                        expect.raw['xhr_url']))
+            return
 
-        trigger_delay = expect.get('trigger_delay', 0)
+        if expect.custom is not None and \
+                not expect.custom(self, frame, *urlparts):
+            return
+
+        self._expectation_matched(context, expect)
+
+        trigger_delay = expect.trigger_delay
         if trigger_delay:
-            try:
-                self._trigger_delay_timer.timeout.disconnect()
-            except Exception as e:
-                pass
+            # in adaptive mode the delay is only the upper bound, the trigger
+            # fires as soon as the page looks ready
+            context.pending_trigger = (frame, expect)
+            context.pending_since = timer()
+            context.trigger_delay_timer.start(int(trigger_delay * 1000))
+            if (expect.trigger_delay_mode or self._delay_mode) == 'adaptive':
+                context.ready_timer.start()
+        else:
+            self.trigger(frame, expect.trigger, expect.trigger_args)
+
+
+    def _expectation_matched(self, context, expect):
+        """ Ends the page's expectations, the transition begins """
+        context.timeline.trigger = expect.trigger
+        context.timeline.mark('matched')
+        latency = timer() - context.expects_since
+        self._transitions += 1
+        self.debug('%s triggered after %.3fs.', expect.trigger, latency)
+        self.transition.emit(expect.trigger, latency)
+        context.expects_active = False
+        context.proxy.active = False
+
+
+    def _on_script_matched(self, context, index, frame_name):
+        """ The page script matched one of the expectations """
+        record = self._frames.get(frame_name)
+        if not context.expects_active or record is None:
+            return
+
+        self._context = context
+        expect = context.expects.expects[index]
+        self._expectation_matched(context, expect)
+        # the proxy waits the trigger delay
+        context.pending_trigger = (record.frame, expect)
+        context.pending_since = timer()
 
-            self._trigger_delay_timer.timeout.connect(partial(self.trigger,
-                    frame=frame, trigger_name=expect['trigger'],
-                    trigger_args=expect.get('trigger_args', [])))
 
-            self._trigger_delay_timer.start(trigger_delay * 1000)
+    def _on_script_trigger(self, context, index, frame_name):
+        if context.pending_trigger is None:
+            return
+
+        frame, expect = context.pending_trigger
+        if expect.trigger_delay:
+            self._fire_pending_trigger(context, False)
         else:
-            self.trigger(frame, expect['trigger'],
-                    expect.get('trigger_args', []))
+            context.pending_trigger = None
+            self.trigger(frame, expect.trigger, expect.trigger_args,
+                    context=context)
+
+
+    def _on_script_call(self, context, handler_name, handler_args,
+            frame_name):
+
+        """ The page script called a handler, outside of any transition """
+        record = self._frames.get(frame_name)
+        handler = context.handlers.get(str(handler_name))
+        if record is None:
+            return
+        if handler is None:
+            self.error('No handler for %s.' % handler_name)
+            return
+
+        self._context = context
+        self._scripts.install(record.frame)
+        handler(self, record.frame, **dict((str(key), handler_args[key]) \
+                for key in handler_args))
+
+
+    def _on_script_add_queue(self, task):
+        self.add_queue(dict((str(key), task[key]) for key in task))
 
 
-    def trigger(self, frame, trigger_name, trigger_args):
-        if self._trigger_delay_timer.isActive():
-            self._trigger_delay_timer.stop()
+    def trigger(self, frame, trigger_name, trigger_args, context=None):
+        if context is not None:
+            self._context = context
+        else:
+            context = self._context
+
+        if context.trigger_delay_timer.isActive():
+            context.trigger_delay_timer.stop()
+        context.ready_timer.stop()
 
         trigger_args = dict((str(key), trigger_args[key]) for \
                 key in trigger_args)
 
-        if trigger_name in self._handlers:
-            self._handlers[trigger_name](self, frame, **trigger_args)
+        # handlers could trigger each other, only the trigger of a fulfilled
+        # expectation ends its transition
+        timeline = context.timeline
+        if timeline is None or not timeline.reached('matched') or \
+                timeline.reached('delay_elapsed'):
+
+            timeline = None
+        else:
+            timeline.mark('delay_elapsed')
+
+        if trigger_name in context.handlers:
+            if frame is not None:
+                self._scripts.install(frame)
+            context.handlers[trigger_name](self, frame, **trigger_args)
+            if timeline is not None:
+                timeline.mark('handler_returned')
+                self._finish_timeline(timeline)
         else:
             self.error('No handler for trigger %s.' % trigger_name)
             self.exit(-1)
 
 
+    def _on_trigger_delay_timeout(self, context):
+        self._fire_pending_trigger(context, False)
+
+
+    def _on_trigger_ready_check(self, context):
+        """
+        Fire the delayed trigger once the network was idle for a while and
+        the element the trigger acts on is visible and enabled.
+        """
+        if context.pending_trigger is None:
+            context.ready_timer.stop()
+            return
+
+        if context.network.idle_time() * 1000 < self._network_idle:
+            return
+
+        frame, expect = context.pending_trigger
+        if expect.trigger_target is not None and \
+                not is_element_ready(frame, expect.trigger_target):
+
+            return
+
+        self._fire_pending_trigger(context, True)
+
+
+    def _fire_pending_trigger(self, context, ready):
+        context.ready_timer.stop()
+        if context.pending_trigger is None:
+            return
+
+        frame, expect = context.pending_trigger
+        context.pending_trigger = None
+
+        delay = timer() - context.pending_since
+        self._trigger_delays.add(expect.trigger, delay, expect.trigger_delay,
+                ready)
+
+        self.debug('%s delayed for %.3fs%s.', expect.trigger, delay,
+                '' if ready else ', the page was not ready')
+
+        self.trigger(frame, expect.trigger, expect.trigger_args,
+                context=context)
+
+
     @staticmethod
     def _on_page_not_found_trigger(app, frame):
         app.error('PageNotFound: %s.' % frame.baseUrl().toString())
@@ -288,71 +703,293 @@ class Application(QApplication):
 
     @staticmethod
     def _on_next_queue_trigger(app, frame=None):
-        if not app._active_task is None:
-            app._queue.task_done()
+        app._start_next_task(app._context)
 
-        try:
-            app._active_task = task = app._queue.get(timeout=15)
-        except Empty:
-            app.info('No more task in the queue.')
-            app.web_view.close()
-            app.exit(0)
+
+    @staticmethod
+    def _on_retry_task_trigger(app, frame=None):
+        """ Start the page's active task again, eg. after logging in again """
+        context = app._context
+        if context.task_retries >= MAX_TASK_RETRIES:
+            app.error('Task has been retried too many times: %s.' % \
+                    context.active_task['goto'])
+
+            app.exit(-1)
             return
 
+        context.task_retries += 1
+        app._run_task(context, context.active_task)
+
+
+    def _finish_timeline(self, timeline, **extra):
+        """ Report the phases of a transition to the `metrics` log """
+        self._phase_histogram.add(timeline)
+        if self.is_logging(INFO, 'metrics'):
+            self.log_event.emit(INFO, timeline.to_json(**extra), 'metrics')
+
+
+    def _start_next_task(self, context):
+        """
+        Finish the page's active task and start the next queued one, returns
+        False if the queue was empty.
+        """
+        if not context.active_task is None:
+            if self._journal is not None and context.task_id is not None:
+                self._journal.task_done(context.task_id)
+            self._queue.done(context.active_task)
+            context.active_task = None
+            context.task_id = None
+            if len(self._queue):
+                # the host limits of other idle pages may be lifted
+                self._queue_timer.start(0)
+
+            if self._should_recycle(context):
+                self._recycle_context(context)
+
+        item = self._queue.get()
+        if item is None:
+            context.expects_active = False
+            wait_time = self._queue.wait_time()
+            if wait_time is not None:
+                # delayed tasks or host limits
+                self._queue_timer.start(int(wait_time * 1000) + 1)
+
+            elif not len(self._queue) and not self._daemon and \
+                    all(x.idle for x in self._contexts):
+
+                self.info('No more task in the queue.')
+                self.exit(0)
+            return False
+
+        task_id, task = item
+        dequeued_at = timer()
+        self._context = context
+        context.active_task = task
+        context.task_id = task_id
+        context.task_retries = 0
+        if self._journal is not None and task_id is not None:
+            self._journal.task_started(task_id)
+        context.network.rules = self._block_rules.merge(task.get('block'))
+
+        self._run_task(context, task)
+        context.timeline.mark('dequeued', dequeued_at)
+        return True
+
+
+    def _run_task(self, context, task):
+        self._context = context
+        # handlers registered or cleared by the previous task of the page
+        # (or attempt of this one) don't carry over
+        context.handlers = dict(self._handlers)
+        context.handlers.update(task.get('handlers') or {})
+
         expects = make_list(task['expects'])
         for expect in expects:
             expect['trigger_wait_pageload'] = True
 
-        app.set_expects(expects)
-        app.load(task['goto'])
+        self.set_expects(expects)
+        self.load(task['goto'])
 
 
-    def _on_expects_timeout(self):
-        self.debug('No expectations were fulfilled after a periode.')
-        self.set_expects(self._expects_if_timeout or [])
-        self.web_page.triggerAction(QWebPage.Stop)
+    def _create_context(self, index):
+        context = PageContext(self, index)
+        context.expects_timer.timeout.connect(partial(
+                self._on_expects_timeout, context))
 
+        context.trigger_delay_timer.timeout.connect(partial(
+                self._on_trigger_delay_timeout, context))
+
+        context.ready_timer.setInterval(int(
+                self.settings['application.trigger.check_interval']))
+
+        context.ready_timer.timeout.connect(partial(
+                self._on_trigger_ready_check, context))
+
+        context.network.rules = self._block_rules
+        context.network.log_event.connect(self.log_event)
+        context.network.request_finished.connect(partial(
+                self._on_request_finished, context))
+
+        context.idle_timer.timeout.connect(partial(self._on_network_idle,
+                context))
+
+        context.proxy.log_event.connect(self.log_event)
+        context.proxy.matched.connect(partial(self._on_script_matched,
+                context))
+
+        context.proxy.onTrigger.connect(partial(self._on_script_trigger,
+                context))
+
+        context.proxy.onCallHandler.connect(partial(self._on_script_call,
+                context))
+
+        context.proxy.onAddQueue.connect(self._on_script_add_queue)
+
+        context.network.set_cookie_jar(self.cookie_jar)
+        context.network.set_archive(self._archive)
+        context.network.set_http_proxy(
+                self.settings['application.network.proxy'])
+        context.network.set_disk_cache(DiskCache.from_settings(self.settings,
+                context.network))
+
+        self._setup_web_page(context)
+        return context
+
+
+    def _setup_web_page(self, context):
+        web_page = context.web_page
+        web_page.log_event.connect(self.log_event)
+        web_page.loadStarted.connect(partial(self._on_page_load_started,
+                context))
+
+        web_page.loadFinished.connect(partial(self._on_page_load_finished,
+                context))
+
+        web_page.frameCreated.connect(partial(self._on_frame_created,
+                context=context))
+
+        self._on_frame_created(web_page.mainFrame(), context)
+        #web_page.networkAccessManager().finished.connect(
+        #        self._on_http_response)
+
+        st = web_page.settings()
+        st.setAttribute(
+            st.AutoLoadImages,
+            int(self.settings['application.settings.load_images']))
+        st.setAttribute(
+            st.JavaEnabled,
+            int(self.settings['application.settings.java_enabled']))
+        st.setAttribute(
+            st.PluginsEnabled,
+            int(self.settings['application.settings.plugins_enabled']))
+
+
+    def _should_recycle(self, context):
+        """
+        Whether the page has grown too much to be used any longer, only a
+        daemon lives long enough for it. The memory limit is shared by the
+        pages, each of them is held to its part of the growth since it was
+        created.
+        """
+        if not self._daemon:
+            return False
+
+        if self._max_pages and context.recycle_loads >= self._max_pages:
+            return True
+
+        if self._max_rss and context.recycle_rss is not None:
+            rss = get_rss()
+            if rss is not None and rss - context.recycle_rss > \
+                    self._max_rss / len(self._contexts):
+
+                return True
+        return False
+
+
+    def _recycle_context(self, context):
+        """
+        Replace the page's view with a new one, only the network access
+        manager with its cookie jar and cache were kept.
+        """
+        rss = get_rss()
+        old_view = context.web_view
+        old_view.stop()
+        old_view.hide()
+        context.load_started = None
+
+        context.create_view(self.name)
+        self._setup_web_page(context)
+        if self._visible:
+            context.web_view.show()
+
+        old_view.deleteLater()
+        # the old view is gone once the event loop deleted it
+        QTimer.singleShot(0, partial(self._on_context_recycled, context,
+                rss))
 
-    def _on_frame_created(self, frame):
-        """ Called when QWebPage created a QWebFrame """
-        frame_name = 'frame-' + uuid4().hex
-        frame.setObjectName(frame_name)
-        frame_data = {
-            ENUM_FRAME_DATA_ACTIVE: False,
-            ENUM_FRAME_DATA_TIMER_CALLBACK: partial(self._on_frame_timer,
-                    frame=frame),
 
-            ENUM_FRAME_DATA_TIMER_COUNTER: 0,
-        }
+    def _on_context_recycled(self, context, rss):
+        QWebSettings.clearMemoryCaches()
+        self.info('Page #%d has been recycled, RSS %s before, %s after.' % (
+                context.index, format_size(rss), format_size(get_rss())))
 
-        with self._frame_data_lock:
-            self._frame_data[frame_name] = frame_data
 
-        self._frame_timer.timeout.connect(
-                frame_data[ENUM_FRAME_DATA_TIMER_CALLBACK])
+    def _on_page_load_started(self, context):
+        context.load_started = timer()
+        if context.timeline is not None:
+            context.timeline.mark('load_started', context.load_started)
+
+
+    def _on_page_load_finished(self, context, success):
+        if context.load_started is None:
+            return
+
+        now = timer()
+        elapsed = now - context.load_started
+        context.load_started = None
+        if context.timeline is not None:
+            context.timeline.mark('load_finished', now)
+
+        context.loads += 1
+        context.recycle_loads += 1
+        context.load_time += elapsed
+        if self.is_logging(DEBUG, 'http'):
+            self.log(DEBUG, 'Page loaded in %.3fs: %s', elapsed,
+                    context.web_page.mainFrame().baseUrl().toString(),
+                    group='http')
+
+
+    def _on_expects_timeout(self, context):
+        self._context = context
+        self.debug('No expectations were fulfilled after a periode.')
+        if context.timeline is not None and \
+                not context.timeline.reached('matched'):
+
+            self._finish_timeline(context.timeline, timed_out=True)
+
+        self.set_expects(context.expects_if_timeout or [])
+        context.web_page.triggerAction(QWebPage.Stop)
+
+
+    def _on_frame_created(self, frame, context):
+        """ Called when QWebPage created a QWebFrame """
+        record, warning = self._frames.add(frame, context)
+        if warning is not None:
+            self.warn(warning)
 
         frame.destroyed.connect(self._on_frame_destroyed)
-        #frame.javaScriptWindowObjectCleared.connect(partial(
-        #        self._on_frame_reset, frame=frame))
-        frame.loadFinished.connect(partial(
-                self._on_frame_loaded, frame=frame))
+        frame.loadFinished.connect(self._on_frame_loaded)
+
+        if self._event_driven or self._scripted:
+            frame.javaScriptWindowObjectCleared.connect(
+                    self._on_frame_cleared)
+
+        if self._event_driven:
+            frame.urlChanged.connect(self._on_frame_event)
 
 
     def _on_frame_destroyed(self, frame):
         """ Called when QWebFrame was destroyed """
-        frame_name = str(frame.objectName())
-        with self._frame_data_lock:
-            frame_data = self._frame_data.get(frame_name)
-            if frame_data is None:
-                return
+        record = self._frames.remove(frame.objectName())
+        if record is None:
+            return
+
+        self._event_frames.discard(record.name)
+        record.context.network.forget_frame(record.name)
+
 
-            del self._frame_data[frame_name]
-            self._frame_timer.timeout.disconnect(
-                    frame_data[ENUM_FRAME_DATA_TIMER_CALLBACK])
+    def _on_frame_loaded(self, success):
+        self._on_frame_reset(self.sender())
 
 
-    def _on_frame_loaded(self, success, frame=None):
-        self._on_frame_reset(frame)
+    def _on_frame_cleared(self):
+        frame = self.sender()
+        if self._event_driven:
+            self._dom_watcher.install(frame)
+
+        record = self._frames.get_frame(frame)
+        if self._scripted and record is not None:
+            record.context.proxy.install(frame)
 
 
     def _on_frame_reset(self, frame=None):
@@ -365,72 +1002,145 @@ class Application(QApplication):
             self.error('Problem while loading the page.')
             self.exit(-1)
             return
-        self.debug('DOMContentLoaded ' + frame.baseUrl().toString())
-
-        frame.evaluateJavaScript("""
-            window.bot = {
-                click: function(el) {
-                    if (el.click) {
-                        el.click()
-                    }
-                    else if (el.fireEvent) {
-                        el.fireEvent('onclick');
-                    }
-                    else {
-                        var evt = document.createEvent('Events');
-                        evt.initEvent('click', true, false);
-                        el.dispatchEvent(evt);
-                    }
-                },
-            };
-        """)
-
-        frame_data = self.get_frame_related_data(frame)
-        frame_data[ENUM_FRAME_DATA_TIMER_COUNTER] = 0
-        frame_data[ENUM_FRAME_DATA_ACTIVE] = True
-
-
-    def _on_frame_timer(self, frame):
-        if not self._expects_active:
-            # we have obsolete expects
+        if self.is_logging(DEBUG):
+            self.debug('DOMContentLoaded ' + frame.baseUrl().toString())
+
+        record = self._frames.get_frame(frame)
+        if record is None:
+            return
+
+        record.generation = record.context.expects_generation
+        record.active = True
+        record.probe = {}
+
+        if self._scripted:
+            record.context.proxy.observe(frame)
+
+        if self._event_driven:
+            record.watched = self._dom_watcher.observe(frame)
+            self._on_dom_mutated(record.name)
+
+
+    def _on_frame_event(self, *args):
+        """
+        Called when something happened to the frame that may fulfill the
+        expectations, the evaluation is postponed a bit so bursts of events
+        were handled once.
+        """
+        self._on_dom_mutated(self.sender().objectName())
+
+
+    def _on_dom_mutated(self, frame_name):
+        record = self._frames.get(frame_name)
+        if record is not None:
+            # cached selectors probe is obsolete
+            record.probe = {}
+            self._schedule_frame(record.name)
+
+
+    def _on_request_finished(self, context, frame_name, url, status):
+        """
+        Completed requests were kept for the `xhr_url` expectations, frames
+        waiting for them or for `network_idle` were evaluated again.
+        """
+        frame_name = str(frame_name)
+        context.requests.append((frame_name, str(url), status, timer()))
+        if not self._event_driven or not context.expects_active:
             return
 
-        frame_data = self.get_frame_related_data(frame)
-        if frame_data is None:
+        if context.expects.xhr:
+            self._schedule_frame(frame_name)
+
+        network_idle = context.expects.network_idle
+        if network_idle is not None and not context.network.in_flight:
+            context.idle_timer.start(network_idle + 1)
+
+
+    def _on_network_idle(self, context):
+        for record in self._frames.of_context(context):
+            self._schedule_frame(record.name)
+
+
+    def _schedule_frame(self, frame_name):
+        """ Evaluate the frame's expectations on the next event tick """
+        self._event_frames.add(frame_name)
+        if not self._event_timer.isActive():
+            self._event_timer.start()
+
+
+    def _on_event_timer(self):
+        frame_names = self._event_frames
+        self._event_frames = set()
+
+        for frame_name in frame_names:
+            record = self._frames.get(frame_name)
+            if record is not None:
+                self._process_record(record)
+
+
+    def _on_frame_timer(self):
+        leaked = self._frames.collect_deleted()
+        if leaked:
+            self.warn('%d frames were deleted without notice.' % leaked)
+
+        for record in self._frames.active():
+            self._process_record(record)
+
+
+    def process_frame(self, frame):
+        """ Evaluate expectations against a frame """
+        record = self._frames.get_frame(frame)
+        if record is not None:
+            self._process_record(record)
+
+
+    def _process_record(self, record):
+        context = record.context
+        if not context.expects_active:
+            # we have obsolete expects
             return
 
-        if not frame_data[ENUM_FRAME_DATA_ACTIVE]:
+        if not record.active:
             # the frame hasn't been fully loaded
             return
 
-        wait_pageload = False
+        if not context.expects.unscripted:
+            # left to the page script
+            return
+
+        self._context = context
+        frame = record.frame
 
+        # the document was loaded before the expectations were set
+        obsolete = record.generation < context.expects_generation
+
+        debug = self.is_logging(DEBUG)
         urlparts = urlsplit(str(frame.baseUrl().toString()))
-        for expect in self._expects:
-            # is it an obsolete frame
-            if expect.get('trigger_wait_pageload', False) and \
-                    frame_data[ENUM_FRAME_DATA_TIMER_COUNTER] > 0:
+        expects = [expect for expect in self._url_matched_expectations(
+                *urlparts, debug=debug) if not (obsolete and \
+                expect.trigger_wait_pageload)]
 
-                wait_pageload = True
-                continue
+        if expects:
+            context.timeline.mark('eligible')
+            probe_started = timer()
+            probe = self.probe_selectors(frame, expects)
+            context.timeline.probe_time += timer() - probe_started
 
-            self.process_expectations(expect, frame, urlparts)
-            if not self._expects_active:
+        for expect in expects:
+            self.process_expectations(expect, frame, urlparts, debug, probe)
+            if not context.expects_active:
                 # one of the triggers has been activated
                 break
 
-        if not wait_pageload:
-            frame_data[ENUM_FRAME_DATA_TIMER_COUNTER] += 1
-
 
     def _pyqt4_null_message_handler(self, msgtype, msg):
         """ Nuke Qt related error messages """
-        self.log_event.emit(DEBUG, str(msg), 'qt')
+        self.log(DEBUG, '%s', msg, group='qt')
 
 
     def _pyqt5_null_message_handler(self, msgtype, msgctx, msg):
         """ Nuke Qt related error messages """
-        self.log_event.emit(DEBUG, str(msg), 'qt')
+        self.log(DEBUG, '%s', msg, group='qt')
 
 
     def _on_http_response(self, response):
@@ -450,23 +1160,14 @@ class Application(QApplication):
         status_code = int(response.attribute(
                 QNetworkRequest.HttpStatusCodeAttribute).toInt())
 
-        for expect in self._expects:
-            if self._url_matched_expectation(expect, scheme, netloc,
-                    path, query, segment):
-
-                self.log_event.emit(WARNING, '%s: %s' % (status_code, url),
-                        'http')
+        if any(context.expects.match_url(netloc, path, segment) for \
+                context in self._contexts):
 
-                break
+            self.log_event.emit(WARNING, '%s: %s' % (status_code, url), 'http')
         else:
             self.log_event.emit(DEBUG, '%s: %s' % (status_code, url), 'http')
 
 
 def get_settings_definition():
-    settings_filename = os.path.join(os.path.dirname(__file__),
-            'application_settings.json')
-
-    with open(settings_filename) as f:
-        settings = json_load(f, object_pairs_hook=OrderedDict)
-
-    return flatten_settings_definition(settings)
+    return load_settings_definition(os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'application_settings.json'))
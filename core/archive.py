@@ -0,0 +1,218 @@
+""" Recorded network responses, replayed for offline runs """
+
+import os
+import sqlite3
+import zlib
+from json import dumps as json_dumps, loads as json_loads
+try:
+    from time import monotonic as timer
+except ImportError:
+    from time import time as timer
+
+from core.helpers import get_base_dir, make_dirs
+
+ARCHIVE_MODES = ('', 'record', 'replay')
+
+# recorded responses written in a single transaction
+FLUSH_SIZE = 50
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS responses (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        method TEXT NOT NULL,
+        url TEXT NOT NULL,
+        error INTEGER NOT NULL DEFAULT 0,
+        status INTEGER NOT NULL DEFAULT 0,
+        reason TEXT,
+        headers TEXT NOT NULL,
+        body BLOB NOT NULL,
+        started REAL NOT NULL,
+        elapsed REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS responses_request ON responses (method, url);
+"""
+
+
+class ArchivedResponse(object):
+    """ A response read from the archive """
+    __slots__ = ('body', 'elapsed', 'error', 'headers', 'reason', 'started',
+            'status')
+
+    def __init__(self, error, status, reason, headers, body, started,
+            elapsed):
+
+        self.error = error
+        self.status = status
+        self.reason = reason
+        # list of (name, value) byte strings, in their original order
+        self.headers = [(name.encode('latin-1'), value.encode('latin-1')) \
+                for name, value in json_loads(headers)]
+
+        self.body = zlib.decompress(body)
+        self.started = started
+        self.elapsed = elapsed
+
+
+class NetworkArchive(object):
+    """
+    SQLite database of the responses of a run, their bodies compressed. When
+    replaying, a request gets the responses recorded for the same method and
+    url in their recorded order, then the last one again.
+
+    `timing` scales the recorded response times while replaying, 0 serves
+    them right away.
+
+    Several processes (workers, zygote jobs) may record in the same archive,
+    they only add to it. `NetworkArchive.reset` starts a new recording, once
+    before they were started.
+    """
+    filename = None
+    lost = 0
+    missing = 0
+    mode = None
+    recorded = 0
+    replayed = 0
+    timing = 1.0
+    _db = None
+    _offsets = None
+    _pending = None
+    _started_at = None
+
+    def __init__(self, filename, mode, timing=1.0):
+        dirname = os.path.dirname(filename)
+        if dirname:
+            make_dirs(dirname)
+
+        self.filename = filename
+        self.mode = mode
+        self.timing = timing
+        self._offsets = {}
+        self._pending = []
+        self._started_at = timer()
+        # other processes may be writing their responses
+        self._db = sqlite3.connect(filename, timeout=30)
+        self._db.executescript(SCHEMA)
+
+
+    @staticmethod
+    def get_filename(settings, name):
+        filename = settings['application.network.archive.filename']
+        if os.path.dirname(filename) == '':
+            filename = os.path.join(get_base_dir(), 'data', '%s-%s' % (name,
+                    filename))
+        return filename
+
+
+    @classmethod
+    def from_settings(cls, settings, name):
+        """ Returns None if the responses weren't recorded nor replayed """
+        mode = settings['application.network.archive.mode']
+        if not mode:
+            return None
+
+        return cls(cls.get_filename(settings, name), mode,
+                float(settings['application.network.archive.timing']))
+
+
+    @classmethod
+    def reset(cls, settings, name):
+        """ Start a new recording if the settings record the responses """
+        if settings['application.network.archive.mode'] != 'record':
+            return
+
+        archive = cls(cls.get_filename(settings, name), 'record')
+        with archive._db:
+            archive._db.execute('DELETE FROM responses')
+        archive.close()
+
+
+    @property
+    def recording(self):
+        return self.mode == 'record'
+
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+
+    def close(self):
+        if self._db is not None:
+            self.flush()
+            self._db.close()
+            self._db = None
+
+
+    def flush(self):
+        """ Write the pending responses in a single transaction """
+        if not self._pending:
+            return
+
+        rows, self._pending = self._pending, []
+        try:
+            with self._db:
+                self._db.executemany('INSERT INTO responses (method, url, ' \
+                        'error, status, reason, headers, body, started, ' \
+                        'elapsed) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        except sqlite3.Error:
+            # eg. locked for too long by another process, called from the
+            # slots of the replies so it may not raise
+            self.lost += len(rows)
+
+
+    def now(self):
+        """ Seconds since the archive was opened """
+        return timer() - self._started_at
+
+
+    def add(self, method, url, error, status, reason, headers, body, started,
+            elapsed):
+
+        """ `headers` is a list of (name, value) byte strings """
+        if self._db is None:
+            # replies finishing after the application exited
+            return
+
+        headers = json_dumps([(name.decode('latin-1'),
+                value.decode('latin-1')) for name, value in headers])
+
+        self._pending.append((method, url, error, status, reason, headers,
+                sqlite3.Binary(zlib.compress(body)), started, elapsed))
+
+        self.recorded += 1
+        if len(self._pending) >= FLUSH_SIZE:
+            self.flush()
+
+
+    def find(self, method, url):
+        """ Next response of a request, None if it wasn't recorded """
+        if self._db is None:
+            return None
+
+        key = (method, url)
+        offset = self._offsets.get(key, 0)
+        query = 'SELECT error, status, reason, headers, body, started, ' \
+                'elapsed FROM responses WHERE method = ? AND url = ? ' \
+                'ORDER BY id %s LIMIT 1 OFFSET ?'
+
+        row = self._db.execute(query % 'ASC', (method, url, offset)).fetchone()
+        if row is None and offset:
+            row = self._db.execute(query % 'DESC', (method, url, 0)).fetchone()
+
+        if row is None:
+            self.missing += 1
+            return None
+
+        self._offsets[key] = offset + 1
+        self.replayed += 1
+        return ArchivedResponse(*row)
+
+
+    def describe(self):
+        if self.recording:
+            if self.lost:
+                return 'Archive: %d responses recorded, %d could not be ' \
+                        'written.' % (self.recorded - self.lost, self.lost)
+            return 'Archive: %d responses recorded.' % self.recorded
+        return 'Archive: %d responses replayed, %d missing.' % (self.replayed,
+                self.missing)
@@ -0,0 +1,270 @@
+""" Precompiled expectations """
+
+import re
+from json import dumps as json_dumps
+
+from core.helpers import make_list
+
+EXPECT_FIELDS = ('path', 'hash', 'host', 'selector_exists',
+        'selector_not_exists', 'trigger', 'trigger_args', 'trigger_delay',
+        'trigger_delay_mode', 'trigger_target', 'trigger_wait_pageload',
+        'network_idle', 'xhr_url', 'xhr_status', 'custom')
+
+TRIGGER_DELAY_MODES = ('fixed', 'adaptive')
+
+EXPECTS_ENGINES = ('python', 'javascript')
+
+# regex syntax of python the javascript RegExp doesn't have
+PYTHON_ONLY_SYNTAX = re.compile(r'\(\?[P<#aiLmsux]|\\[AZ]')
+
+PROBE_JS_SOURCE = """
+    (function(selectors) {
+        var result = '';
+        for (var i = 0; i < selectors.length; i++) {
+            try {
+                result += document.querySelector(selectors[i]) ? '1' : '0';
+            }
+            catch (e) {
+                result += '0';
+            }
+        }
+        return result;
+    })(%s);
+"""
+
+READY_JS_SOURCE = """
+    (function(selector) {
+        var el = document.querySelector(selector);
+        if (!el || el.disabled) {
+            return '0';
+        }
+        var rect = el.getBoundingClientRect();
+        if (!rect.width && !rect.height) {
+            return '0';
+        }
+        var style = window.getComputedStyle(el);
+        if (style.visibility == 'hidden' || style.display == 'none') {
+            return '0';
+        }
+        return '1';
+    })(%s);
+"""
+
+_patterns = {}
+
+
+def compile_pattern(pattern):
+    """ Compiled regex for a pattern, shared between all expectations """
+    if pattern is None:
+        return None
+    compiled = _patterns.get(pattern)
+    if compiled is None:
+        compiled = _patterns[pattern] = re.compile(pattern)
+    return compiled
+
+
+def is_scriptable(item, default_delay_mode='fixed'):
+    """
+    Whether an expectation dict could be evaluated by the page script,
+    `default_delay_mode` is the `application.trigger.delay_mode` settings.
+    """
+    if item.get('custom') is not None or item.get('xhr_url') is not None or \
+            item.get('network_idle') is not None:
+
+        return False
+
+    # waiting for the page to be ready needs the python probes
+    if item.get('trigger_delay') and (item.get('trigger_delay_mode') or \
+            default_delay_mode) == 'adaptive':
+
+        return False
+
+    return not any(PYTHON_ONLY_SYNTAX.search(item[key]) for key in \
+            ('host', 'path', 'hash') if item.get(key))
+
+
+def probe_selectors(frame, selectors):
+    """
+    Test which css selectors exist in a frame's document with a single
+    javascript call, returns a dict of selector and boolean.
+    """
+    if not selectors:
+        return {}
+
+    result = frame.evaluateJavaScript(PROBE_JS_SOURCE % json_dumps(
+            list(selectors)))
+
+    if hasattr(result, 'toString'):
+        # PyQt4 QVariant
+        result = result.toString()
+    bitmap = str(result or '')
+    return dict((selector, bitmap[ii:ii + 1] == '1') for ii, selector in \
+            enumerate(selectors))
+
+
+def is_element_ready(frame, selector):
+    """ Whether an element exists, is visible and isn't disabled """
+    result = frame.evaluateJavaScript(READY_JS_SOURCE % json_dumps(selector))
+    if hasattr(result, 'toString'):
+        # PyQt4 QVariant
+        result = result.toString()
+    return str(result or '') == '1'
+
+
+class UrlGroup(object):
+    """
+    Expectations sharing the same host and path patterns, a single test rules
+    them all out.
+    """
+    __slots__ = ('host', 'path')
+
+    def __init__(self, host, path):
+        self.host = compile_pattern(host)
+        self.path = compile_pattern(path)
+
+
+    def mismatch(self, netloc, path):
+        """ Name of the first url part that doesn't match, or None """
+        if self.host is not None and not self.host.match(netloc):
+            return 'host'
+        if self.path is not None and not self.path.match(path):
+            return 'path'
+        return None
+
+
+class Expectation(object):
+    """ Immutable, precompiled form of an expectation dict """
+    __slots__ = ('custom', 'group', 'hash', 'network_idle', 'raw',
+            'scriptable', 'selector_exists', 'selector_not_exists', 'trigger',
+            'trigger_args', 'trigger_delay', 'trigger_delay_mode',
+            'trigger_target', 'trigger_wait_pageload', 'xhr_status',
+            'xhr_url')
+
+    def __init__(self, item, group, default_delay_mode='fixed'):
+        init = super(Expectation, self).__setattr__
+        init('raw', item)
+        init('group', group)
+        init('hash', compile_pattern(item.get('hash')))
+        init('selector_exists', tuple(make_list(item.get('selector_exists'))))
+        init('selector_not_exists', tuple(make_list(
+                item.get('selector_not_exists'))))
+
+        init('trigger', item.get('trigger'))
+        init('trigger_args', item.get('trigger_args') or {})
+        init('trigger_delay', item.get('trigger_delay', 0))
+        # None means the `application.trigger.delay_mode` settings
+        init('trigger_delay_mode', item.get('trigger_delay_mode'))
+        init('trigger_target', item.get('trigger_target') or \
+                (self.selector_exists[0] if self.selector_exists else None))
+
+        init('trigger_wait_pageload', bool(item.get('trigger_wait_pageload',
+                False)))
+
+        # milliseconds without requests of the frame in flight
+        network_idle = item.get('network_idle')
+        init('network_idle', None if network_idle is None else \
+                int(network_idle))
+
+        # a request of the frame matching the url pattern has completed, with
+        # one of the status codes if they were given
+        init('xhr_url', compile_pattern(item.get('xhr_url')))
+        init('xhr_status', tuple(int(x) for x in \
+                make_list(item.get('xhr_status'))))
+
+        init('custom', item.get('custom'))
+        init('scriptable', is_scriptable(item, default_delay_mode))
+
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Expectation is immutable.')
+
+
+    def __delattr__(self, name):
+        raise AttributeError('Expectation is immutable.')
+
+
+    @property
+    def selectors(self):
+        return self.selector_exists + self.selector_not_exists
+
+
+    def describe_mismatch(self, netloc, path, segment):
+        """ Debug message explaining why the url wasn't matched """
+        field = self.group.mismatch(netloc, path)
+        if field == 'host':
+            return '%s location.host: "%s" "%s"' % (self.trigger,
+                    self.raw['host'], netloc)
+        if field == 'path':
+            return '%s location.pathname: "%s" "%s"' % (self.trigger,
+                    self.raw['path'], path)
+        if self.hash is not None and not self.hash.match(segment):
+            return '%s location.hash: "%s" "%s"' % (self.trigger,
+                    self.raw['hash'], segment)
+        return None
+
+
+    def match_request(self, requests, frame_name, since):
+        """
+        Whether one of the completed `(frame_name, url, status, at)` requests
+        fulfills `xhr_url` and `xhr_status`.
+        """
+        for name, url, status, at in requests:
+            if name == frame_name and at >= since and \
+                    self.xhr_url.search(url) and \
+                    (not self.xhr_status or status in self.xhr_status):
+
+                return True
+        return False
+
+
+class ExpectationIndex(object):
+    """
+    Expectations compiled once in `Application.set_expects`, grouped by their
+    host and path patterns. If `scripted`, the expectations the page script
+    can evaluate were left to it, see `core.proxy`. `delay_mode` is the
+    trigger delay mode of the expectations which don't set one.
+    """
+    __slots__ = ('expects', 'groups', 'network_idle', 'scripted',
+            'unscripted', 'xhr')
+
+    def __init__(self, items, scripted=False, delay_mode='fixed'):
+        groups = {}
+        expects = []
+        for item in make_list(items):
+            if isinstance(item, Expectation):
+                item = item.raw
+            key = (item.get('host'), item.get('path'))
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = UrlGroup(*key)
+            expects.append(Expectation(item, group, delay_mode))
+
+        self.expects = tuple(expects)
+        self.groups = tuple(groups.values())
+        self.scripted = tuple(x for x in expects if scripted and x.scriptable)
+        self.unscripted = tuple(x for x in expects if not x in self.scripted)
+        self.xhr = any(x.xhr_url is not None for x in expects)
+        # longest idle periode waited for, None if no expectation needs it
+        self.network_idle = max([x.network_idle for x in expects \
+                if x.network_idle is not None] or [None])
+
+
+    def __iter__(self):
+        return iter(self.expects)
+
+
+    def __len__(self):
+        return len(self.expects)
+
+
+    def match_url(self, netloc, path, segment):
+        """
+        Expectations evaluated in python whose url patterns match, in their
+        original order.
+        """
+        rejected = set(group for group in self.groups \
+                if group.mismatch(netloc, path) is not None)
+
+        return [expect for expect in self.unscripted \
+                if not expect.group in rejected and \
+                (expect.hash is None or expect.hash.match(segment))]
@@ -0,0 +1,83 @@
+""" Structured data pulled out of a frame's document """
+
+from json import dumps as json_dumps, loads as json_loads
+
+EXTRACT_JS_SOURCE = """
+    (function(spec, offset, limit) {
+        var rows = document.querySelectorAll(spec.rows);
+        var result = [];
+        for (var i = offset; i < rows.length && i < offset + limit; i++) {
+            var row = {};
+            for (var name in spec.fields) {
+                var field = spec.fields[name];
+                var el = field.selector ?
+                        rows[i].querySelector(field.selector) : rows[i];
+
+                var value = null;
+                if (el && field.attribute) {
+                    value = el.getAttribute(field.attribute);
+                }
+                else if (el && field.html) {
+                    value = el.innerHTML;
+                }
+                else if (el) {
+                    value = el.textContent.replace(/\\s+/g, ' ').trim();
+                }
+                if (value !== null && field.regex) {
+                    var match = new RegExp(field.regex).exec(value);
+                    value = match ? match[match.length > 1 ? 1 : 0] : null;
+                }
+                row[name] = value;
+            }
+            result.push(row);
+        }
+        return JSON.stringify({total: rows.length, rows: result});
+    })(%s, %d, %d);
+"""
+
+
+def compile_spec(spec):
+    """
+    Normalized extraction spec. `rows` is the css selector of the records,
+    `fields` maps names to the css selector of an element inside the row
+    (its text is extracted), or to a dict of:
+
+        selector: element inside the row, the row itself if empty
+        attribute: value of the attribute instead of the text
+        html: the inner html instead of the text
+        regex: javascript regex applied to the value, its first group (or
+            the whole match) is kept, null if it didn't match
+    """
+    fields = {}
+    for name, field in spec['fields'].items():
+        if field is None or not isinstance(field, dict):
+            field = {'selector': field}
+        fields[name] = dict(field)
+    return {'rows': spec['rows'], 'fields': fields}
+
+
+def extract(frame, spec, chunk_size=500):
+    """
+    Generator of dicts, a record per row of the spec. Every `chunk_size`
+    rows cost a single javascript call, rows added or removed by the page in
+    between may be skipped or repeated.
+    """
+    source = json_dumps(compile_spec(spec))
+    offset = 0
+    while True:
+        result = frame.evaluateJavaScript(EXTRACT_JS_SOURCE % (source, offset,
+                chunk_size))
+
+        if hasattr(result, 'toString'):
+            # PyQt4 QVariant
+            result = result.toString()
+        if not result:
+            return
+
+        data = json_loads(str(result))
+        for row in data['rows']:
+            yield row
+
+        offset += chunk_size
+        if offset >= data['total']:
+            return
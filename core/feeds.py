@@ -0,0 +1,260 @@
+""" Tasks fed to a running application from outside """
+
+import os
+import sqlite3
+from importlib import import_module
+from json import loads as json_loads
+try:
+    from PyQt5.QtCore import QFileSystemWatcher, QObject, QTimer
+    from PyQt5.QtNetwork import QLocalServer
+except ImportError:
+    from PyQt4.QtCore import QFileSystemWatcher, QObject, QTimer
+    from PyQt4.QtNetwork import QLocalServer
+
+from core.helpers import get_base_dir, make_dirs, make_list
+from core.journal import resolve_callable_ref
+
+try:
+    string_types = (str, unicode)
+except NameError:
+    string_types = (str,)
+
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS tasks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'new',
+        error TEXT
+    );
+"""
+
+
+def load_task(data):
+    """
+    Task of a JSON message: `goto` and `expects` as for
+    `Application.add_queue`, `custom` expectations as "module:name" and the
+    name of a `module` whose `get_handlers()` has the task's handlers.
+    """
+    if isinstance(data, string_types):
+        data = json_loads(data)
+    if not isinstance(data, dict) or not data.get('goto'):
+        raise ValueError('A task needs a "goto" url.')
+
+    task = dict(data)
+    task['expects'] = [dict(x) for x in make_list(task.get('expects'))]
+    for expect in task['expects']:
+        custom = expect.get('custom')
+        if isinstance(custom, string_types):
+            expect['custom'] = resolve_callable_ref(custom)
+
+    module_name = task.pop('module', None)
+    if module_name:
+        task['handlers'] = dict(import_module(module_name).get_handlers())
+    return task
+
+
+def get_feed_path(value, name):
+    if os.path.dirname(value) == '':
+        return os.path.join(get_base_dir(), 'data', '%s-%s' % (name, value))
+    return value
+
+
+class Feed(QObject):
+    """ Source of tasks, they were added to the application's queue """
+    app = None
+
+    def __init__(self, app):
+        super(Feed, self).__init__(app)
+        self.app = app
+
+
+    def start(self):
+        pass
+
+
+    def stop(self):
+        pass
+
+
+    def feed(self, data, origin):
+        """ Queue a task, returns an error message or None """
+        try:
+            task = load_task(data)
+        except (AttributeError, ImportError, TypeError, ValueError) as e:
+            self.app.warn('Invalid task from %s: %s' % (origin, e))
+            return str(e)
+
+        self.app.debug('Task from %s: %s' % (origin, task['goto']))
+        self.app.add_queue(task)
+        return None
+
+
+class SpoolFeed(Feed):
+    """
+    Directory of `*.json` files, with a task or a task per line. Files were
+    deleted once queued, invalid ones renamed to `*.error`. Write the files
+    under another name and rename them, so they're never read half written.
+    """
+    directory = None
+    _watcher = None
+
+    def __init__(self, app, directory):
+        super(SpoolFeed, self).__init__(app)
+
+        make_dirs(directory)
+
+        self.directory = directory
+        self._watcher = QFileSystemWatcher(self)
+        self._watcher.directoryChanged.connect(self.scan)
+
+
+    def start(self):
+        self._watcher.addPath(self.directory)
+        self.scan()
+
+
+    def stop(self):
+        self._watcher.removePath(self.directory)
+
+
+    def scan(self, *args):
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.json'):
+                continue
+
+            filename = os.path.join(self.directory, filename)
+            try:
+                with open(filename) as f:
+                    lines = [x for x in f.read().splitlines() if x.strip()]
+            except IOError:
+                continue
+
+            # a single JSON object may span several lines
+            try:
+                messages = [json_loads('\n'.join(lines))]
+            except ValueError:
+                messages = lines
+
+            errors = [self.feed(message, filename) for message in messages]
+            if any(errors):
+                os.rename(filename, filename[:-len('.json')] + '.error')
+            else:
+                os.remove(filename)
+
+
+class SocketFeed(Feed):
+    """
+    UNIX socket reading a task per line as JSON, every line is answered with
+    "ok" or "error: <message>".
+    """
+    path = None
+    _server = None
+
+    def __init__(self, app, path):
+        super(SocketFeed, self).__init__(app)
+        self.path = path
+        self._server = QLocalServer(self)
+        self._server.newConnection.connect(self._on_new_connection)
+
+
+    def start(self):
+        # left by a crashed process
+        QLocalServer.removeServer(self.path)
+        if not self._server.listen(self.path):
+            self.app.error('Cannot listen to %s: %s' % (self.path,
+                    self._server.errorString()))
+
+
+    def stop(self):
+        self._server.close()
+
+
+    def _on_new_connection(self):
+        while self._server.hasPendingConnections():
+            socket = self._server.nextPendingConnection()
+            socket.readyRead.connect(self._on_ready_read)
+            socket.disconnected.connect(socket.deleteLater)
+
+
+    def _on_ready_read(self):
+        socket = self.sender()
+        while socket.canReadLine():
+            line = bytes(socket.readLine()).decode('utf-8').strip()
+            if not line:
+                continue
+
+            error = self.feed(line, self.path)
+            if error is None:
+                socket.write(b'ok\n')
+            else:
+                socket.write(('error: %s\n' % error).encode('utf-8'))
+
+
+class SQLiteFeed(Feed):
+    """
+    SQLite database polled for new rows in its `tasks` table, their status
+    becomes "queued" or "error".
+    """
+    filename = None
+    _db = None
+    _timer = None
+
+    def __init__(self, app, filename, interval):
+        super(SQLiteFeed, self).__init__(app)
+
+        dirname = os.path.dirname(filename)
+        if dirname:
+            make_dirs(dirname)
+
+        self.filename = filename
+        self._db = sqlite3.connect(filename, isolation_level=None)
+        self._db.executescript(SQLITE_SCHEMA)
+
+        self._timer = QTimer(self)
+        self._timer.setInterval(interval)
+        self._timer.timeout.connect(self.poll)
+
+
+    def start(self):
+        self._timer.start()
+        self.poll()
+
+
+    def stop(self):
+        self._timer.stop()
+        self._db.close()
+
+
+    def poll(self):
+        rows = self._db.execute("SELECT id, task FROM tasks WHERE " \
+                "status = 'new' ORDER BY id").fetchall()
+
+        for row_id, data in rows:
+            error = self.feed(data, '%s #%d' % (self.filename, row_id))
+            if error is None:
+                self._db.execute("UPDATE tasks SET status = 'queued' " \
+                        "WHERE id = ?", (row_id,))
+            else:
+                self._db.execute("UPDATE tasks SET status = 'error', " \
+                        "error = ? WHERE id = ?", (error, row_id))
+
+
+def create_feeds(app):
+    """ Feeds enabled in the settings """
+    settings = app.settings
+    feeds = []
+
+    spool = settings['application.feeds.spool']
+    if spool:
+        feeds.append(SpoolFeed(app, get_feed_path(spool, app.name)))
+
+    socket = settings['application.feeds.socket']
+    if socket:
+        feeds.append(SocketFeed(app, get_feed_path(socket, app.name)))
+
+    database = settings['application.feeds.sqlite']
+    if database:
+        feeds.append(SQLiteFeed(app, get_feed_path(database, app.name),
+                int(settings['application.feeds.poll_interval'])))
+
+    return feeds
@@ -0,0 +1,121 @@
+""" Frames of the browser pages """
+
+try:
+    from PyQt5 import sip
+except ImportError:
+    try:
+        import sip
+    except ImportError:
+        sip = None
+
+
+class FrameRecord(object):
+    """ Workflow state of a QWebFrame """
+    __slots__ = ('active', 'context', 'frame', 'generation', 'name', 'probe',
+            'watched')
+
+    def __init__(self, name, frame, context):
+        self.name = name
+        self.frame = frame
+        self.context = context
+        # the document has been loaded
+        self.active = False
+        # `expects_generation` of the context when the document was loaded,
+        # older documents don't fulfill `trigger_wait_pageload`
+        self.generation = 0
+        # cached result of `probe_selectors`
+        self.probe = {}
+        # the document is watched for mutations
+        self.watched = False
+
+
+class FrameRegistry(object):
+    """
+    Frames of every page by their object name. Everything runs in the Qt
+    thread, there is no locking.
+    """
+    created = 0
+    leak_threshold = 0
+    leaked = 0
+    peak = 0
+    _records = None
+    _warn_at = 0
+
+    def __init__(self, leak_threshold=0):
+        self._records = {}
+        self.leak_threshold = leak_threshold
+        self._warn_at = leak_threshold
+
+
+    def __len__(self):
+        return len(self._records)
+
+
+    def add(self, frame, context):
+        """
+        Register a frame, returns the record and a warning message if there
+        are suspiciously many live frames.
+        """
+        self.created += 1
+        name = 'frame-%d' % self.created
+        frame.setObjectName(name)
+
+        record = self._records[name] = FrameRecord(name, frame, context)
+        self.peak = max(self.peak, len(self._records))
+
+        warning = None
+        if self._warn_at and len(self._records) > self._warn_at:
+            warning = '%d frames are alive, they may have leaked.' % \
+                    len(self._records)
+
+            self._warn_at *= 2
+        return record, warning
+
+
+    def get(self, frame_name):
+        return self._records.get(str(frame_name))
+
+
+    def get_frame(self, frame):
+        return self._records.get(str(frame.objectName()))
+
+
+    def remove(self, frame_name):
+        record = self._records.pop(str(frame_name), None)
+        if self._warn_at > self.leak_threshold and \
+                len(self._records) <= self._warn_at // 4:
+
+            self._warn_at //= 2
+        return record
+
+
+    def active(self):
+        """ Records of the loaded frames, a list so frames can go away """
+        return [record for record in self._records.values() if record.active]
+
+
+    def of_context(self, context):
+        return [record for record in self._records.values() \
+                if record.context is context]
+
+
+    def collect_deleted(self):
+        """
+        Forget the frames whose C++ object was deleted without a `destroyed`
+        signal, returns how many.
+        """
+        if sip is None:
+            return 0
+
+        deleted = [name for name, record in self._records.items() \
+                if sip.isdeleted(record.frame)]
+
+        for name in deleted:
+            self.remove(name)
+        self.leaked += len(deleted)
+        return len(deleted)
+
+
+    def describe(self):
+        return 'Frames: %d alive, %d at most, %d created, %d leaked.' % (
+                len(self._records), self.peak, self.created, self.leaked)
@@ -1,14 +1,28 @@
 import os
 import sys
 from ast import literal_eval
-from collections import Mapping
+from collections import Mapping, OrderedDict
 from getpass import getpass
+from glob import glob
+try:
+    # python2.6 support
+    from simplejson import load as json_load
+except ImportError:
+    from json import load as json_load
 from re import compile, sub as subst
 try:
     from urllib.parse import urlsplit, urlunsplit
 except ImportError:
     from urlparse import urlsplit, urlunsplit
 
+# missing settings are asked for, see `disable_prompts`
+_prompts_enabled = True
+
+def disable_prompts():
+    """ Missing settings raise EOFError instead of being asked for """
+    global _prompts_enabled
+    _prompts_enabled = False
+
 
 def evaluate_conditional(expr_list, context):
     re_replacement = compile(r'({([\w.]+)})')
@@ -89,6 +103,55 @@ def flatten_settings_definition(data, prefix=None):
     yield (prefix, data)
 
 
+_settings_definitions = {}
+
+def load_settings_definition(filename):
+    """
+    Flattened definition of a settings JSON file, parsed once per process so
+    forked jobs get it for free.
+    """
+    result = _settings_definitions.get(filename)
+    if result is None:
+        with open(filename) as f:
+            settings = json_load(f, object_pairs_hook=OrderedDict)
+
+        result = _settings_definitions[filename] = list(
+                flatten_settings_definition(settings))
+    return result
+
+
+def preload_settings_definitions():
+    """ Parse the settings definitions of every module """
+    for dirname in ('core', 'modules', 'tasks'):
+        for filename in glob(os.path.join(get_base_dir(), dirname,
+                '*_settings.json')):
+
+            load_settings_definition(os.path.realpath(filename))
+
+
+def get_base_dir():
+    """ Directory of the project, relative filenames in settings start here """
+    return os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def get_rss():
+    """ Resident memory of this process in bytes, None if unknown """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def format_size(size):
+    if size is None:
+        return 'unknown'
+    return '%.1fMB' % (size / 1048576.0)
+
+
 def get_settings_value(name, config, settings_in_file):
     if name in settings_in_file:
         return settings_in_file[name]
@@ -100,6 +163,10 @@ def get_settings_value(name, config, settings_in_file):
     if 'default' in config:
         return config['default']
 
+    if not _prompts_enabled:
+        # getpass would read the terminal even without a stdin
+        raise EOFError('Missing settings "%s".' % name)
+
     if config.get('masked', False):
         fn_input = getpass
     elif sys.version_info[0] >= 3:
@@ -137,6 +204,15 @@ def is_non_string_iterable(data):
     return False
 
 
+def make_dirs(path):
+    """ os.makedirs, unless another process created the directory first """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
 def make_list(items, nodict=True):
     if items is None:
         return []
@@ -149,7 +225,12 @@ def make_list(items, nodict=True):
 
 
 def traverse_dom_element(element, excludes=[]):
-    while child:
+    """
+    Descendants of a QWebElement, crosses the javascript bridge for every
+    node, prefer `core.extract` for bulk data.
+    """
+    child = element.firstChild()
+    while not child.isNull():
         if not child.tagName() in excludes:
             yield child
         for c in traverse_dom_element(child, excludes):
@@ -0,0 +1,161 @@
+""" Progress of a run kept on disk, so it can be resumed """
+
+import os
+import sqlite3
+from importlib import import_module
+from json import dumps as json_dumps, loads as json_loads
+
+from core.helpers import get_base_dir, make_dirs
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task TEXT NOT NULL,
+        active INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS handlers (
+        name TEXT PRIMARY KEY,
+        ref TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS done (
+        key TEXT PRIMARY KEY
+    );
+"""
+
+
+def get_callable_ref(value):
+    """ "module:name" of a module level function or class attribute """
+    name = getattr(value, '__qualname__', None) or \
+            getattr(value, '__name__', None)
+
+    module = getattr(value, '__module__', None)
+    if not name or not module or '<' in name:
+        return None
+
+    ref = '%s:%s' % (module, name)
+    try:
+        if resolve_callable_ref(ref) is value:
+            return ref
+    except (AttributeError, ImportError):
+        pass
+    return None
+
+
+def resolve_callable_ref(ref):
+    module_name, name = ref.split(':', 1)
+    result = import_module(module_name)
+    for part in name.split('.'):
+        result = getattr(result, part)
+    return result
+
+
+def _encode(value):
+    ref = get_callable_ref(value) if callable(value) else None
+    if ref is None:
+        raise TypeError('%r cannot be saved in the journal.' % value)
+    return {'__callable__': ref}
+
+
+def _decode(value):
+    if len(value) == 1 and '__callable__' in value:
+        return resolve_callable_ref(value['__callable__'])
+    return value
+
+
+class Journal(object):
+    """
+    SQLite database of the queued tasks, registered handlers and completed
+    items of a run. Every change is committed right away, a killed process
+    loses nothing but the state of the page it was working on.
+    """
+    filename = None
+    _db = None
+
+    def __init__(self, filename):
+        dirname = os.path.dirname(filename)
+        if dirname:
+            make_dirs(dirname)
+
+        self.filename = filename
+        self._db = sqlite3.connect(filename, isolation_level=None)
+        self._db.executescript(SCHEMA)
+
+
+    @classmethod
+    def from_settings(cls, settings, name):
+        """ Returns None if the journal was disabled """
+        filename = settings['application.journal.filename']
+        if not filename:
+            return None
+
+        if os.path.dirname(filename) == '':
+            filename = os.path.join(get_base_dir(), 'data', '%s-%s' % (name,
+                    filename))
+
+        return cls(filename)
+
+
+    def close(self):
+        self._db.close()
+
+
+    def reset(self):
+        """ Forget the previous run """
+        with self._db:
+            self._db.execute('DELETE FROM queue')
+            self._db.execute('DELETE FROM handlers')
+            self._db.execute('DELETE FROM done')
+
+
+    def add_task(self, task):
+        """ Returns the task's id, None if it couldn't be saved """
+        try:
+            data = json_dumps(task, default=_encode)
+        except (TypeError, ValueError):
+            return None
+
+        return self._db.execute('INSERT INTO queue (task) VALUES (?)',
+                (data,)).lastrowid
+
+
+    def task_started(self, task_id):
+        self._db.execute('UPDATE queue SET active = 1 WHERE id = ?',
+                (task_id,))
+
+
+    def task_done(self, task_id):
+        self._db.execute('DELETE FROM queue WHERE id = ?', (task_id,))
+
+
+    def tasks(self):
+        """ Unfinished tasks, the interrupted ones first """
+        return [(task_id, json_loads(data, object_hook=_decode)) for \
+                task_id, data in self._db.execute('SELECT id, task FROM ' \
+                'queue ORDER BY active DESC, id')]
+
+
+    def set_handler(self, name, callback):
+        """ Returns False if the handler can't be restored later """
+        ref = get_callable_ref(callback)
+        if ref is None:
+            return False
+
+        self._db.execute('INSERT OR REPLACE INTO handlers (name, ref) ' \
+                'VALUES (?, ?)', (name, ref))
+
+        return True
+
+
+    def handlers(self):
+        return [(name, resolve_callable_ref(ref)) for name, ref in \
+                self._db.execute('SELECT name, ref FROM handlers')]
+
+
+    def mark_done(self, key):
+        self._db.execute('INSERT OR IGNORE INTO done (key) VALUES (?)',
+                (key,))
+
+
+    def is_done(self, key):
+        return self._db.execute('SELECT 1 FROM done WHERE key = ?',
+                (key,)).fetchone() is not None
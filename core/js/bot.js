@@ -0,0 +1,93 @@
+/**
+ * Helpers of the handlers, eg. `element.evaluateJavaScript('bot.click(this)')`
+ */
+window.bot = {
+    version: 2,
+
+    click: function(el) {
+        if (el.click) {
+            el.click();
+        }
+        else if (el.fireEvent) {
+            el.fireEvent('onclick');
+        }
+        else {
+            var evt = document.createEvent('Events');
+            evt.initEvent('click', true, false);
+            el.dispatchEvent(evt);
+        }
+    },
+
+    /**
+     * Set the value of a form field the way typing would, scripts of the
+     * page listening to the input events notice the change.
+     */
+    fill: function(el, value) {
+        if (el.focus) {
+            el.focus();
+        }
+        el.value = value;
+        var names = ['input', 'change'];
+        for (var i = 0; i < names.length; i++) {
+            var evt = document.createEvent('Events');
+            evt.initEvent(names[i], true, false);
+            el.dispatchEvent(evt);
+        }
+    },
+
+    /**
+     * Scroll an element into view, or the window to a vertical offset, or
+     * to the bottom of the document without arguments.
+     */
+    scroll: function(target) {
+        if (target && target.scrollIntoView) {
+            target.scrollIntoView();
+        }
+        else if (typeof target == 'number') {
+            window.scrollTo(0, target);
+        }
+        else {
+            window.scrollTo(0, document.body.scrollHeight);
+        }
+    },
+
+    /**
+     * Call `callback` with the first element of a selector once it exists,
+     * or with null after `timeout` milliseconds.
+     */
+    waitFor: function(selector, callback, timeout) {
+        var started = new Date().getTime();
+        var check = function() {
+            var el = document.querySelector(selector);
+            if (el) {
+                callback(el);
+            }
+            else if (timeout && new Date().getTime() - started > timeout) {
+                callback(null);
+            }
+            else {
+                setTimeout(check, 100);
+            }
+        };
+        check();
+    },
+
+    /**
+     * Values of the elements of a selector as JSON, `fields` maps names to
+     * an attribute or "text", eg. {"id": "data-id", "name": "text"}.
+     */
+    collect: function(selector, fields) {
+        var result = [];
+        var els = document.querySelectorAll(selector);
+        for (var i = 0; i < els.length; i++) {
+            var row = {};
+            for (var name in fields) {
+                row[name] = fields[name] == 'text' ?
+                        els[i].textContent.trim() :
+                        els[i].getAttribute(fields[name]);
+            }
+            result.push(row);
+        }
+        return JSON.stringify(result);
+    },
+};
@@ -0,0 +1,149 @@
+""" Timing of the workflow transitions """
+
+from collections import OrderedDict
+from json import dumps as json_dumps
+try:
+    from time import monotonic as timer
+except ImportError:
+    from time import time as timer
+
+# lifecycle of a transition, in order
+PHASES = ('dequeued', 'load_started', 'load_finished', 'eligible', 'matched',
+        'delay_elapsed', 'handler_returned')
+
+# upper bounds of the histogram buckets (seconds)
+BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Timeline(object):
+    """
+    Timestamps of the phases of a single transition of a page, it starts when
+    expectations were set and ends when the triggered handler returned.
+    """
+    __slots__ = ('page', 'probe_time', 'started', 'times', 'trigger')
+
+    def __init__(self, page):
+        self.page = page
+        self.probe_time = 0.0
+        self.started = timer()
+        self.times = {}
+        self.trigger = None
+
+
+    def mark(self, phase, at=None):
+        """ Only the first occurence of a phase is kept """
+        if phase in self.times:
+            return
+
+        if at is None:
+            at = timer()
+        elif at < self.started:
+            # eg. the task was dequeued before its expectations were set
+            self.started = at
+        self.times[phase] = at
+
+
+    def reached(self, phase):
+        return phase in self.times
+
+
+    def durations(self):
+        """
+        Time spent reaching each phase, since the previous phase that was
+        reached.
+        """
+        result = []
+        previous = self.started
+        for phase in PHASES:
+            at = self.times.get(phase)
+            if at is None:
+                continue
+            result.append((phase, max(0.0, at - previous)))
+            previous = at
+        return result
+
+
+    def to_json(self, **extra):
+        record = {
+            'page': self.page,
+            'probe': round(self.probe_time, 6),
+            'trigger': self.trigger,
+            'phases': dict((phase, round(at - self.started, 6)) for \
+                    phase, at in self.times.items()),
+        }
+        record.update(extra)
+        return json_dumps(record, sort_keys=True)
+
+
+class PhaseHistogram(object):
+    """ Bucketed durations of every phase, summarized at exit """
+    def __init__(self):
+        self._phases = {}
+
+
+    def add(self, timeline):
+        for phase, duration in timeline.durations():
+            stats = self._phases.get(phase)
+            if stats is None:
+                stats = self._phases[phase] = [0, 0.0, 0.0,
+                        [0] * (len(BUCKETS) + 1)]
+
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            for index, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    break
+            else:
+                index = len(BUCKETS)
+            stats[3][index] += 1
+
+
+    def summary(self):
+        """ Lines of text, a phase per line """
+        header = ['%-16s %6s %9s %9s' % ('phase', 'count', 'mean', 'max')]
+        header[0] += ''.join(' %6s' % ('<%gs' % x) for x in BUCKETS) + \
+                '  longer'
+
+        lines = []
+        for phase in PHASES:
+            stats = self._phases.get(phase)
+            if stats is None:
+                continue
+            count, total, maximum, buckets = stats
+            lines.append('%-16s %6d %8.3fs %8.3fs' % (phase, count,
+                    total / count, maximum) + \
+                    ''.join(' %6d' % x for x in buckets[:-1]) + \
+                    ' %7d' % buckets[-1])
+
+        return header + lines if lines else []
+
+
+class TriggerDelays(object):
+    """
+    Trigger delays actually waited, per trigger, to tune the `trigger_delay`
+    of the expectations.
+    """
+    def __init__(self):
+        self._triggers = OrderedDict()
+
+
+    def add(self, trigger, delay, limit, ready):
+        """ `ready` is False if the delay ran until its `limit` """
+        stats = self._triggers.get(trigger)
+        if stats is None:
+            stats = self._triggers[trigger] = [0, 0.0, 0.0, 0, limit]
+
+        stats[0] += 1
+        stats[1] += delay
+        stats[2] = max(stats[2], delay)
+        if not ready:
+            stats[3] += 1
+
+
+    def summary(self):
+        """ Lines of text, a trigger per line """
+        return ['%s: %d delays, mean %.3fs, max %.3fs, %d reached the %gs ' \
+                'limit' % (trigger, count, total / count, maximum, limited,
+                limit) for trigger, (count, total, maximum, limited, limit) \
+                in self._triggers.items()]
@@ -0,0 +1,747 @@
+""" Network access of the browser pages """
+
+import os
+import re
+from fnmatch import fnmatch
+from functools import partial
+from logging import getLogger, DEBUG, INFO, WARNING
+from mimetypes import guess_type
+try:
+    from time import monotonic as timer
+except ImportError:
+    from time import time as timer
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+try:
+    import fcntl
+except ImportError:
+    # no locking between processes on this platform
+    fcntl = None
+try:
+    from PyQt5.QtCore import QDateTime, QIODevice, QTimer, QUrl, pyqtSignal
+    from PyQt5.QtNetwork import QNetworkAccessManager, QNetworkCookie
+    from PyQt5.QtNetwork import QNetworkCookieJar, QNetworkDiskCache
+    from PyQt5.QtNetwork import QNetworkProxy, QNetworkReply, QNetworkRequest
+except ImportError:
+    from PyQt4.QtCore import QDateTime, QIODevice, QTimer, QUrl, pyqtSignal
+    from PyQt4.QtNetwork import QNetworkAccessManager, QNetworkCookie
+    from PyQt4.QtNetwork import QNetworkCookieJar, QNetworkDiskCache
+    from PyQt4.QtNetwork import QNetworkProxy, QNetworkReply, QNetworkRequest
+
+from core.helpers import get_base_dir, make_dirs, make_list
+
+
+OPERATION_NAMES = {
+    QNetworkAccessManager.HeadOperation: 'HEAD',
+    QNetworkAccessManager.GetOperation: 'GET',
+    QNetworkAccessManager.PutOperation: 'PUT',
+    QNetworkAccessManager.PostOperation: 'POST',
+    QNetworkAccessManager.DeleteOperation: 'DELETE',
+}
+
+
+def split_setting(value):
+    """ List from a comma or whitespace separated settings value """
+    return [x for x in re.split(r'[\s,]+', value or '') if x]
+
+
+def get_originating_frame_name(request):
+    """ Name of the QWebFrame which made the request, or '' """
+    try:
+        origin = request.originatingObject()
+    except AttributeError:
+        # Qt < 4.7
+        return ''
+    if origin is None:
+        return ''
+    return str(origin.objectName())
+
+
+class BlockRules(object):
+    """
+    Which requests shouldn't reach the network, matched by file extension,
+    mime type (patterns like `image/*`), host (including subdomains) or
+    regex of the whole url.
+    """
+    extensions = ()
+    hosts = ()
+    mime_types = ()
+    urls = ()
+
+    def __init__(self, extensions=None, hosts=None, mime_types=None,
+            urls=None):
+
+        self.extensions = frozenset(x.lower().lstrip('.') for x in \
+                make_list(extensions))
+
+        self.hosts = tuple(x.lower().lstrip('.') for x in make_list(hosts))
+        self.mime_types = tuple(x.lower() for x in make_list(mime_types))
+        self.urls = tuple(re.compile(x) for x in make_list(urls))
+
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+                extensions=split_setting(
+                        settings['application.network.block.extensions']),
+                hosts=split_setting(
+                        settings['application.network.block.hosts']),
+                mime_types=split_setting(
+                        settings['application.network.block.mime_types']),
+                urls=split_setting(
+                        settings['application.network.block.urls']))
+
+
+    def merge(self, rules=None):
+        """ New rules extended with a task's `block` dict """
+        if not rules:
+            return self
+
+        merged = BlockRules()
+        merged.extensions = self.extensions | BlockRules(
+                extensions=rules.get('extensions')).extensions
+
+        merged.hosts = self.hosts + BlockRules(hosts=rules.get('hosts')).hosts
+        merged.mime_types = self.mime_types + BlockRules(
+                mime_types=rules.get('mime_types')).mime_types
+
+        merged.urls = self.urls + BlockRules(urls=rules.get('urls')).urls
+        return merged
+
+
+    def __bool__(self):
+        return bool(self.extensions or self.hosts or self.mime_types or \
+                self.urls)
+
+    __nonzero__ = __bool__
+
+
+    def match_mime(self, mime_type):
+        mime_type = mime_type.split(';', 1)[0].strip().lower()
+        for pattern in self.mime_types:
+            if fnmatch(mime_type, pattern):
+                return True
+        return False
+
+
+    def match_url(self, url):
+        """ Reason the url was blocked, or None """
+        scheme, netloc, path, query, segment = urlsplit(url)
+        if not scheme in ('http', 'https'):
+            return None
+
+        ext = os.path.splitext(path)[1][1:].lower()
+        if ext and ext in self.extensions:
+            return 'extension'
+
+        host = netloc.rsplit('@', 1)[-1].split(':', 1)[0].lower()
+        for blocked_host in self.hosts:
+            if host == blocked_host or host.endswith('.' + blocked_host):
+                return 'host'
+
+        if self.mime_types:
+            mime_type = guess_type(path)[0]
+            if mime_type and self.match_mime(mime_type):
+                return 'mime'
+
+        for pattern in self.urls:
+            if pattern.search(url):
+                return 'url'
+
+        return None
+
+
+class BlockedReply(QNetworkReply):
+    """ Reply of a blocked request, fails without touching the network """
+    def __init__(self, request, operation, parent=None):
+        super(BlockedReply, self).__init__(parent)
+
+        self.setRequest(request)
+        self.setUrl(request.url())
+        self.setOperation(operation)
+        self.setError(QNetworkReply.ContentAccessDenied, 'Blocked')
+        self.open(QIODevice.ReadOnly | QIODevice.Unbuffered)
+
+        QTimer.singleShot(0, self._on_finish)
+
+
+    def _on_finish(self):
+        self.error.emit(QNetworkReply.ContentAccessDenied)
+        self.finished.emit()
+
+
+    def abort(self):
+        pass
+
+
+    def bytesAvailable(self):
+        return 0
+
+
+    def isSequential(self):
+        return True
+
+
+    def readData(self, maxlen):
+        return None
+
+
+def get_operation_name(operation, request):
+    """ Http method of a request """
+    name = OPERATION_NAMES.get(operation)
+    if name is None:
+        verb = request.attribute(QNetworkRequest.CustomVerbAttribute)
+        if hasattr(verb, 'toByteArray'):
+            # PyQt4 QVariant
+            verb = verb.toByteArray()
+        name = bytes(verb or b'').decode('latin-1') or 'CUSTOM'
+    return name
+
+
+def get_reply_attribute(reply, attribute):
+    value = reply.attribute(attribute)
+    if hasattr(value, 'toPyObject'):
+        # PyQt4 QVariant
+        value = value.toPyObject()
+    return value
+
+
+class RecordingReply(QNetworkReply):
+    """
+    Passes a network reply through to the page, its response is saved to a
+    `NetworkArchive` once it has finished.
+    """
+    _archive = None
+    _body = None
+    _buffer = b''
+    _method = None
+    _reply = None
+    _started = 0.0
+
+    def __init__(self, reply, method, archive, parent=None):
+        super(RecordingReply, self).__init__(parent)
+
+        self.setRequest(reply.request())
+        self.setUrl(reply.url())
+        self.setOperation(reply.operation())
+        self.open(QIODevice.ReadOnly | QIODevice.Unbuffered)
+
+        self._archive = archive
+        self._body = []
+        self._method = method
+        self._started = archive.now()
+        self._reply = reply
+        reply.setParent(self)
+        reply.metaDataChanged.connect(self._on_metadata)
+        reply.readyRead.connect(self._on_ready_read)
+        reply.downloadProgress.connect(self.downloadProgress)
+        reply.uploadProgress.connect(self.uploadProgress)
+        reply.finished.connect(self._on_finished)
+
+
+    def _on_metadata(self):
+        for name, value in self._reply.rawHeaderPairs():
+            self.setRawHeader(name, value)
+
+        for attribute in (QNetworkRequest.HttpStatusCodeAttribute,
+                QNetworkRequest.HttpReasonPhraseAttribute,
+                QNetworkRequest.RedirectionTargetAttribute):
+
+            self.setAttribute(attribute, self._reply.attribute(attribute))
+        self.metaDataChanged.emit()
+
+
+    def _on_ready_read(self):
+        data = bytes(self._reply.readAll())
+        self._body.append(data)
+        self._buffer += data
+        self.readyRead.emit()
+
+
+    def _on_finished(self):
+        reply = self._reply
+        error = reply.error()
+        if error != QNetworkReply.NoError:
+            self.setError(error, reply.errorString())
+
+        self._archive.add(self._method, str(reply.url().toString()),
+                int(error), int(get_reply_attribute(reply,
+                QNetworkRequest.HttpStatusCodeAttribute) or 0),
+                str(get_reply_attribute(reply,
+                QNetworkRequest.HttpReasonPhraseAttribute) or ''),
+                [(bytes(name), bytes(value)) for name, value in \
+                reply.rawHeaderPairs()], b''.join(self._body),
+                self._started, self._archive.now() - self._started)
+
+        if error != QNetworkReply.NoError:
+            self.error.emit(error)
+        self.finished.emit()
+
+
+    def abort(self):
+        self._reply.abort()
+
+
+    def bytesAvailable(self):
+        return len(self._buffer) + \
+                super(RecordingReply, self).bytesAvailable()
+
+
+    def isSequential(self):
+        return True
+
+
+    def readData(self, maxlen):
+        data = self._buffer[:maxlen]
+        self._buffer = self._buffer[maxlen:]
+        return data
+
+
+class ReplayReply(QNetworkReply):
+    """
+    Reply served from a `NetworkArchive` without touching the network, after
+    the recorded response time scaled by the archive's timing. Requests that
+    weren't recorded fail with 404.
+
+    The recorded bodies were already decoded, their encoding and length
+    headers were replaced to describe the body actually served.
+    """
+    # headers of the body as it came from the network
+    body_headers = (b'content-encoding', b'content-length',
+            b'transfer-encoding')
+
+    _buffer = b''
+    _cookie_jar = None
+    _response = None
+    _timer = None
+
+    def __init__(self, request, operation, response, timing, cookie_jar=None,
+            parent=None):
+
+        super(ReplayReply, self).__init__(parent)
+
+        self.setRequest(request)
+        self.setUrl(request.url())
+        self.setOperation(operation)
+        self.open(QIODevice.ReadOnly | QIODevice.Unbuffered)
+
+        self._cookie_jar = cookie_jar
+        self._response = response
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self._on_finish)
+        self._timer.start(0 if response is None else \
+                int(response.elapsed * timing * 1000))
+
+
+    def _on_finish(self):
+        response = self._response
+        if response is None:
+            self.setError(QNetworkReply.ContentNotFoundError,
+                    'Not in the archive')
+
+            self.error.emit(QNetworkReply.ContentNotFoundError)
+            self.finished.emit()
+            return
+
+        if response.status:
+            self.setAttribute(QNetworkRequest.HttpStatusCodeAttribute,
+                    response.status)
+
+            self.setAttribute(QNetworkRequest.HttpReasonPhraseAttribute,
+                    response.reason)
+
+        for name, value in response.headers:
+            lower_name = name.lower()
+            if lower_name in self.body_headers:
+                continue
+
+            self.setRawHeader(name, value)
+            if lower_name == b'location' and 300 <= response.status < 400:
+                self.setAttribute(QNetworkRequest.RedirectionTargetAttribute,
+                        QUrl(value.decode('latin-1')))
+
+            elif lower_name == b'set-cookie' and \
+                    self._cookie_jar is not None:
+
+                # done by QNetworkAccessManager for the network replies
+                self._cookie_jar.setCookiesFromUrl(
+                        QNetworkCookie.parseCookies(value), self.url())
+
+        self.setRawHeader(b'Content-Length', str(len(response.body)).encode(
+                'ascii'))
+
+        self._buffer = response.body
+        self.metaDataChanged.emit()
+        self.downloadProgress.emit(len(response.body), len(response.body))
+        if response.error:
+            self.setError(response.error, 'Replayed error')
+            self.error.emit(response.error)
+        if self._buffer:
+            self.readyRead.emit()
+        self.finished.emit()
+
+
+    def abort(self):
+        if self._timer.isActive():
+            self._timer.stop()
+            self.setError(QNetworkReply.OperationCanceledError, 'Aborted')
+            self.error.emit(QNetworkReply.OperationCanceledError)
+            self.finished.emit()
+
+
+    def bytesAvailable(self):
+        return len(self._buffer) + super(ReplayReply, self).bytesAvailable()
+
+
+    def isSequential(self):
+        return True
+
+
+    def readData(self, maxlen):
+        data = self._buffer[:maxlen]
+        self._buffer = self._buffer[maxlen:]
+        return data
+
+
+class DiskCache(QNetworkDiskCache):
+    """
+    On-disk http cache that can be shared between processes, expiring the
+    cache is serialized with a lock file.
+
+    QNetworkDiskCache expires the oldest files by their creation date, cache
+    items were rewritten on their first hit in a run so frequently used items
+    were kept.
+    """
+    hits = 0
+    misses = 0
+    saved_bytes = 0
+    _lock_filename = None
+    _refreshed = None
+    _refreshing = False
+
+    def __init__(self, directory, max_size, parent=None):
+        super(DiskCache, self).__init__(parent)
+
+        make_dirs(directory)
+
+        self._lock_filename = os.path.join(directory, '.lock')
+        self._refreshed = set()
+        self.setCacheDirectory(directory)
+        self.setMaximumCacheSize(max_size)
+
+
+    @classmethod
+    def from_settings(cls, settings, parent=None):
+        """ Returns None if the cache was disabled """
+        directory = settings['application.network.cache.directory']
+        if not directory:
+            return None
+
+        if not os.path.isabs(directory):
+            directory = os.path.join(get_base_dir(), directory)
+
+        return cls(directory, int(settings['application.network.cache.size']),
+                parent)
+
+
+    def data(self, url):
+        device = super(DiskCache, self).data(url)
+        if self._refreshing:
+            return device
+
+        if device is None:
+            self.misses += 1
+            return device
+
+        self.hits += 1
+        self.saved_bytes += device.size()
+
+        key = str(url.toString())
+        if not key in self._refreshed:
+            self._refreshed.add(key)
+            self._refreshing = True
+            try:
+                self.updateMetaData(self.metaData(url))
+            finally:
+                self._refreshing = False
+
+        return device
+
+
+    def metaData(self, url):
+        meta_data = super(DiskCache, self).metaData(url)
+        if not self._refreshing and not meta_data.isValid():
+            self.misses += 1
+        return meta_data
+
+
+    def expire(self):
+        if fcntl is None:
+            return super(DiskCache, self).expire()
+
+        with open(self._lock_filename, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                return super(DiskCache, self).expire()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class CookieJar(QNetworkCookieJar):
+    """
+    Cookie jar saved to a file, shared by all pages so a logged in session
+    can be reused by the next run. Session cookies were saved too.
+    """
+    filename = None
+    _save_timer = None
+
+    def __init__(self, filename, parent=None):
+        super(CookieJar, self).__init__(parent)
+
+        self.filename = filename
+        self._save_timer = QTimer(self)
+        self._save_timer.setSingleShot(True)
+        self._save_timer.setInterval(1000)
+        self._save_timer.timeout.connect(self.save)
+
+        self.load()
+
+
+    @classmethod
+    def from_settings(cls, settings, name, parent=None):
+        """ Returns None if the cookies shouldn't be saved """
+        filename = settings['application.network.cookies.filename']
+        if not filename:
+            return None
+
+        if os.path.dirname(filename) == '':
+            filename = os.path.join(get_base_dir(), 'data', '%s-%s' % (name,
+                    filename))
+
+        return cls(filename, parent)
+
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+
+        now = QDateTime.currentDateTime()
+        cookies = []
+        with open(self.filename, 'rb') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                for cookie in QNetworkCookie.parseCookies(line):
+                    if cookie.isSessionCookie() or \
+                            cookie.expirationDate() > now:
+
+                        cookies.append(cookie)
+
+        self.setAllCookies(cookies)
+
+
+    def save(self):
+        self._save_timer.stop()
+
+        dirname = os.path.dirname(self.filename)
+        if dirname:
+            make_dirs(dirname)
+
+        # other processes may use the same file, replace it atomically
+        tmp_filename = '%s.%d.tmp' % (self.filename, os.getpid())
+        fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                0o600)
+
+        with os.fdopen(fd, 'wb') as f:
+            for cookie in self.allCookies():
+                f.write(bytes(cookie.toRawForm(QNetworkCookie.Full)) + b'\n')
+
+        os.rename(tmp_filename, self.filename)
+
+
+    def has_cookies(self, url, names):
+        """ Whether unexpired cookies of these names were sent to the url """
+        found = set(bytes(cookie.name()).decode('utf-8') for cookie in \
+                self.cookiesForUrl(QUrl(url)))
+
+        return all(name in found for name in names)
+
+
+    def setCookiesFromUrl(self, cookies, url):
+        result = super(CookieJar, self).setCookiesFromUrl(cookies, url)
+        if result:
+            self._save_timer.start()
+        return result
+
+
+class NetworkAccessManager(QNetworkAccessManager):
+    """
+    Network access manager of a `WebPage`, requests matching the block rules
+    were aborted before they reach the network. With an archive the
+    responses were recorded, or replayed instead of reaching the network.
+    """
+    archive = None
+    blocked = 0
+    in_flight = 0
+    log_event = pyqtSignal(int, str, str)
+    # emitted with the originating frame's name, url and http status code
+    request_finished = pyqtSignal(str, str, int)
+    rules = None
+    _frames = None
+    _idle_since = None
+
+    def __init__(self, parent=None):
+        super(NetworkAccessManager, self).__init__(parent)
+        self.rules = BlockRules()
+        self._idle_since = timer()
+        # frame name: [requests in flight, idle since]
+        self._frames = {}
+
+
+    def idle_time(self, frame_name=None):
+        """
+        Seconds without requests in flight, of the whole page or of a single
+        frame, 0 if there are some.
+        """
+        if frame_name is None:
+            if self.in_flight:
+                return 0.0
+            return timer() - self._idle_since
+
+        state = self._frames.get(frame_name)
+        if state is None:
+            return timer() - self._idle_since
+        if state[0]:
+            return 0.0
+        return timer() - state[1]
+
+
+    def forget_frame(self, frame_name):
+        self._frames.pop(frame_name, None)
+
+
+    def set_cookie_jar(self, cookie_jar):
+        """ Use a cookie jar that is shared with other pages """
+        if cookie_jar is None:
+            return
+
+        parent = cookie_jar.parent()
+        self.setCookieJar(cookie_jar)
+        # setCookieJar() took the ownership
+        cookie_jar.setParent(parent)
+
+
+    def set_http_proxy(self, address):
+        """ Send requests through a `host:port` http proxy """
+        if not address:
+            return
+
+        host, port = address.rsplit(':', 1)
+        self.setProxy(QNetworkProxy(QNetworkProxy.HttpProxy, host, int(port)))
+
+
+    def set_archive(self, archive):
+        """ Record or replay the responses, see `core.archive` """
+        self.archive = archive
+
+
+    def set_disk_cache(self, cache):
+        if cache is not None:
+            self.setCache(cache)
+
+
+    def report_cache(self):
+        """ Log the disk cache counters """
+        cache = self.cache()
+        if not isinstance(cache, DiskCache):
+            return
+
+        self.log_event.emit(INFO, 'Cache: %d hits, %d misses, %d bytes ' \
+                'saved, %d bytes used.' % (cache.hits, cache.misses,
+                cache.saved_bytes, cache.cacheSize()), 'http')
+
+
+    def createRequest(self, operation, request, data=None):
+        url = str(request.url().toString())
+
+        reason = self.rules.match_url(url)
+        if reason is not None:
+            self.blocked += 1
+            if getLogger('http').isEnabledFor(DEBUG):
+                self.log_event.emit(DEBUG, 'Blocked (%s): %s' % (reason, url),
+                        'http')
+
+            return BlockedReply(request, operation, self)
+
+        archive = self.archive
+        if archive is not None and archive.replaying:
+            response = archive.find(get_operation_name(operation, request),
+                    url)
+
+            if response is None:
+                self.log_event.emit(WARNING, 'Not in the archive: %s' % url,
+                        'http')
+
+            reply = ReplayReply(request, operation, response, archive.timing,
+                    self.cookieJar(), self)
+        else:
+            reply = super(NetworkAccessManager, self).createRequest(
+                    operation, request, data)
+
+            if archive is not None and archive.recording:
+                reply = RecordingReply(reply, get_operation_name(operation,
+                        request), archive, self)
+
+        if self.rules.mime_types:
+            reply.metaDataChanged.connect(partial(self._on_reply_metadata,
+                    reply))
+
+        frame_name = get_originating_frame_name(request)
+        state = self._frames.get(frame_name)
+        if state is None:
+            state = self._frames[frame_name] = [0, timer()]
+        state[0] += 1
+
+        self.in_flight += 1
+        reply.finished.connect(partial(self._on_reply_finished, reply,
+                frame_name))
+
+        return reply
+
+
+    def _on_reply_finished(self, reply, frame_name):
+        now = timer()
+        self.in_flight = max(0, self.in_flight - 1)
+        if not self.in_flight:
+            self._idle_since = now
+
+        state = self._frames.get(frame_name)
+        if state is not None:
+            state[0] = max(0, state[0] - 1)
+            if not state[0]:
+                state[1] = now
+
+        status = reply.attribute(QNetworkRequest.HttpStatusCodeAttribute)
+        if hasattr(status, 'toInt'):
+            # PyQt4 QVariant
+            status = status.toInt()[0]
+
+        self.request_finished.emit(frame_name, str(reply.url().toString()),
+                int(status or 0))
+
+
+    def _on_reply_metadata(self, reply):
+        content_type = reply.header(QNetworkRequest.ContentTypeHeader)
+        if hasattr(content_type, 'toString'):
+            # PyQt4 QVariant
+            content_type = content_type.toString()
+        if content_type and self.rules.match_mime(str(content_type)):
+            self.blocked += 1
+            self.log_event.emit(DEBUG, 'Blocked (mime): %s' % \
+                    reply.url().toString(), 'http')
+
+            reply.abort()
@@ -0,0 +1,99 @@
+""" Browser page with its own workflow state """
+
+from collections import deque
+
+try:
+    from PyQt5.QtCore import QObject, QTimer
+    from PyQt5.QtWebKitWidgets import QWebView
+except ImportError:
+    from PyQt4.QtCore import QObject, QTimer
+    from PyQt4.QtWebKit import QWebView
+
+from core.expects import ExpectationIndex
+from core.helpers import get_rss
+from core.network import NetworkAccessManager
+from core.proxy import Proxy
+from core.webpage import WebPage
+
+
+class PageContext(QObject):
+    """
+    One `WebPage` of the `Application`'s pool, tasks from the queue were
+    dispatched to whichever context is idle.
+    """
+    active_task = None
+    expects = None
+    expects_active = False
+    # increased by every `set_expects`, see `FrameRecord.generation`
+    expects_generation = 0
+    expects_if_timeout = None
+    expects_since = None
+    expects_timer = None
+    handlers = None
+    idle_timer = None
+    index = 0
+    load_started = None
+    load_time = 0.0
+    loads = 0
+    network = None
+    pending_since = None
+    # frame and expectation waiting for its trigger delay
+    pending_trigger = None
+    # evaluates the expectations in the page script
+    proxy = None
+    ready_timer = None
+    # page loads since the view was created
+    recycle_loads = 0
+    # resident memory of the process when the view was created
+    recycle_rss = None
+    # recently completed (frame name, url, status code, time) requests
+    requests = None
+    # row of the active task in the journal
+    task_id = None
+    task_retries = 0
+    # phases of the current transition, see `core.metrics`
+    timeline = None
+    trigger_delay_timer = None
+    web_page = None
+    web_view = None
+
+    def __init__(self, app, index):
+        super(PageContext, self).__init__(app)
+
+        self.index = index
+
+        self.expects = ExpectationIndex([])
+        self.expects_if_timeout = []
+        self.expects_timer = QTimer(self)
+        self.expects_timer.setSingleShot(True)
+
+        self.trigger_delay_timer = QTimer(self)
+        self.trigger_delay_timer.setSingleShot(True)
+        self.ready_timer = QTimer(self)
+        self.idle_timer = QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.requests = deque(maxlen=256)
+        self.proxy = Proxy(self)
+
+        self.network = NetworkAccessManager(self)
+        self.create_view(app.name)
+
+
+    def create_view(self, name):
+        """ New view and page, using the same network access manager """
+        self.recycle_loads = 0
+        self.recycle_rss = get_rss()
+        self.web_view = QWebView()
+        self.web_view.setWindowTitle('%s #%d' % (name, self.index))
+        self.web_page = WebPage(self.web_view)
+        self.web_page.setNetworkAccessManager(self.network)
+        self.web_view.setPage(self.web_page)
+
+
+    @property
+    def idle(self):
+        return self.active_task is None
+
+
+    def __repr__(self):
+        return '<PageContext #%d>' % self.index
@@ -1,53 +1,246 @@
+""" Expectations evaluated by javascript inside the pages """
+
 from functools import partial
+from json import dumps as json_dumps
 from logging import DEBUG, ERROR, INFO, WARNING
-from PyQt4.QtCore import pyqtSignal, pyqtSlot, pyqtProperty, QObject, QTimer
+try:
+    from PyQt5.QtCore import pyqtSignal, pyqtSlot, pyqtProperty, QObject, \
+            QTimer
+except ImportError:
+    from PyQt4.QtCore import pyqtSignal, pyqtSlot, pyqtProperty, QObject, \
+            QTimer
+
+PROXY_JS_NAME = 'botProxy'
+
+EXPECTS_JS_SOURCE = """
+    (function(frameName) {
+        var proxy = window.%(name)s;
+        if (!proxy) {
+            return false;
+        }
+        if (window.__botExpecting) {
+            return true;
+        }
+        window.__botExpecting = true;
+
+        // expectations waiting for a page load only apply to documents
+        // loaded after they were set
+        var loadGeneration = proxy.generation;
+        var generation = -1;
+        var expects = [];
+
+        var compile = function(pattern) {
+            // python's re.match is anchored at the start
+            return pattern ? new RegExp('^(?:' + pattern + ')') : null;
+        };
+
+        var exists = function(selector) {
+            try {
+                return !!document.querySelector(selector);
+            }
+            catch (e) {
+                return false;
+            }
+        };
+
+        var load = function() {
+            generation = proxy.generation;
+            expects = JSON.parse(proxy.expects);
+            for (var i = 0; i < expects.length; i++) {
+                expects[i].host = compile(expects[i].host);
+                expects[i].path = compile(expects[i].path);
+                expects[i].hash = compile(expects[i].hash);
+            }
+        };
+
+        var matches = function(expect) {
+            if (expect.wait_pageload && loadGeneration < generation) {
+                return false;
+            }
+            if ((expect.host && !expect.host.test(location.host)) ||
+                    (expect.path && !expect.path.test(location.pathname)) ||
+                    (expect.hash && !expect.hash.test(
+                    location.hash.replace(/^#/, '')))) {
+
+                return false;
+            }
+            for (var i = 0; i < expect.selector_exists.length; i++) {
+                if (!exists(expect.selector_exists[i])) {
+                    return false;
+                }
+            }
+            for (var i = 0; i < expect.selector_not_exists.length; i++) {
+                if (exists(expect.selector_not_exists[i])) {
+                    return false;
+                }
+            }
+            return true;
+        };
+
+        var pending = false;
+        var evaluate = function() {
+            pending = false;
+            if (!proxy.active) {
+                return;
+            }
+            if (generation != proxy.generation) {
+                load();
+            }
+            for (var i = 0; i < expects.length; i++) {
+                if (matches(expects[i])) {
+                    proxy.trigger(generation, expects[i].index, frameName);
+                    return;
+                }
+            }
+        };
+
+        window.__botEvaluate = function() {
+            if (pending) {
+                return;
+            }
+            pending = true;
+            setTimeout(evaluate, 0);
+        };
+
+        var Observer = window.MutationObserver ||
+                window.WebKitMutationObserver;
+
+        if (Observer) {
+            new Observer(window.__botEvaluate).observe(document, {
+                attributes: true,
+                characterData: true,
+                childList: true,
+                subtree: true,
+            });
+        }
+        else {
+            document.addEventListener('DOMSubtreeModified',
+                    window.__botEvaluate, false);
+        }
+        window.addEventListener('hashchange', window.__botEvaluate, false);
+        window.addEventListener('popstate', window.__botEvaluate, false);
+
+        window.__botEvaluate();
+        return true;
+    })('%%s');
+""" % {'name': PROXY_JS_NAME}
+
+NOTIFY_JS_SOURCE = """
+    if (window.__botEvaluate) {
+        window.__botEvaluate();
+    }
+"""
 
-class FrameData(QObject):
-    _name = ''
 
-    def _get_name(self):
-        return self._name
+class Proxy(QObject):
+    """
+    Expectations of a page pushed into its frames, the page script evaluates
+    them on DOM mutations and location changes and calls `trigger` once one
+    matched. Frames were identified by their object name, expectations by
+    their index in the `ExpectationIndex`.
+    """
+    log_event = pyqtSignal(int, str, str)
+    _data = None
+    _delay_timer = None
+    _delays = None
+    _expects = '[]'
+
+    def __init__(self, parent=None):
+        super(Proxy, self).__init__(parent)
+        self._data = {}
+        self._delays = {}
+        self._delay_timer = QTimer(self)
+        self._delay_timer.setSingleShot(True)
+
+
+    def set_expects(self, expects):
+        """ Push the scripted expectations of an `ExpectationIndex` """
+        items = []
+        self._delays = {}
+        for index, expect in enumerate(expects.expects):
+            if not expect in expects.scripted:
+                continue
+
+            items.append({
+                'index': index,
+                'host': expect.raw.get('host'),
+                'path': expect.raw.get('path'),
+                'hash': expect.raw.get('hash'),
+                'selector_exists': list(expect.selector_exists),
+                'selector_not_exists': list(expect.selector_not_exists),
+                'wait_pageload': expect.trigger_wait_pageload,
+            })
+            self._delays[index] = expect.trigger_delay
+
+        self._generation += 1
+        self._expects = json_dumps(items)
+        self._active = bool(items)
+
+
+    def stop(self):
+        self._active = False
+        self._delay_timer.stop()
 
-    def set_name(self, value):
-        self._name = value
 
-    name = pyqtProperty(str, fget=_get_name)
+    def install(self, frame):
+        """ Called when the javascript `window` object of a frame was reset """
+        frame.addToJavaScriptWindowObject(PROXY_JS_NAME, self)
 
 
-class Proxy(QObject):
-    _expects = None
-    _data = None
-    _delay_timer = None
+    def observe(self, frame):
+        """
+        Start evaluating the expectations in a loaded frame's document,
+        returns False if the bridge object wasn't available in the frame.
+        """
+        result = frame.evaluateJavaScript(EXPECTS_JS_SOURCE % \
+                str(frame.objectName()))
+
+        if hasattr(result, 'toBool'):
+            # PyQt4 QVariant
+            result = result.toBool()
+        return bool(result)
 
 
-    onTrigger = pyqtSignal(str, 'QVariantMap', FrameData)
+    def notify(self, frame):
+        """ Evaluate the expectations of a frame again, eg. they were set """
+        frame.evaluateJavaScript(NOTIFY_JS_SOURCE)
 
-    def _trigger(self, trigger_name, trigger_args, frame_data):
-        self.onTrigger.emit(trigger_name, trigger_args, frame_data)
 
-    @pyqtSlot(str, 'QVariantMap', int, FrameData)
-    def trigger(self, trigger_name, trigger_args, trigger_delay, frame_data):
+    matched = pyqtSignal(int, str)
+    onTrigger = pyqtSignal(int, str)
+
+    def _trigger(self, index, frame_name):
+        self.onTrigger.emit(index, frame_name)
+
+    @pyqtSlot(int, int, str)
+    def trigger(self, generation, index, frame_name):
+        # frames could still be evaluating the previous expectations
+        if not self._active or generation != self._generation:
+            return
+
         self._active = False
-        if trigger_delay > 0:
+        self.matched.emit(index, frame_name)
+
+        trigger_delay = self._delays.get(index)
+        if trigger_delay:
             try:
                 self._delay_timer.timeout.disconnect()
-            except:
+            except TypeError:
                 pass
 
-            self._delay_timer.timeout.connect(partial(self._trigger,
-                    trigger_name=trigger_name, trigger_args=trigger_args,
-                    frame_data=frame_data))
+            self._delay_timer.timeout.connect(partial(self._trigger, index,
+                    frame_name))
 
-            self._delay_timer.start(trigger_delay * 1000)
+            self._delay_timer.start(int(trigger_delay * 1000))
         else:
-            self._trigger(trigger_name, trigger_args, frame_data)
+            self._trigger(index, frame_name)
 
 
-    onCallHandler = pyqtSignal(str, 'QVariantMap', FrameData)
+    onCallHandler = pyqtSignal(str, 'QVariantMap', str)
 
-    @pyqtSlot(str, 'QVariantMap', FrameData)
-    def call(self, handler_name, handler_args, frame_data):
-        self.onCallHandler.emit(handler_name, handler_args, frame_data)
+    @pyqtSlot(str, 'QVariantMap', str)
+    def call(self, handler_name, handler_args, frame_name):
+        self.onCallHandler.emit(handler_name, handler_args, frame_name)
 
 
     _active = False
@@ -61,26 +254,18 @@ class Proxy(QObject):
     active = pyqtProperty(bool, fget=_get_active, fset=_set_active)
 
 
-    _trigger_wait_page_load = False
-
-    def _get_trigger_wait_page_load(self):
-        return self._trigger_wait_page_load
+    _generation = 0
 
-    def _set_trigger_wait_page_load(self, value):
-        self._trigger_wait_page_load = value
+    def _get_generation(self):
+        return self._generation
 
-    trigger_wait_page_load = pyqtProperty(bool,
-            fget=_get_trigger_wait_page_load, fset=_set_trigger_wait_page_load)
+    generation = pyqtProperty(int, fget=_get_generation)
 
 
     def _get_expects(self):
         return self._expects
 
-    def set_expects(self, value):
-        self._expects = value
-        self._active = True
-
-    expects = pyqtProperty('QVariantList', fget=_get_expects)
+    expects = pyqtProperty(str, fget=_get_expects)
 
 
     def _get_data(self):
@@ -96,28 +281,21 @@ class Proxy(QObject):
 
     @pyqtSlot('QVariantMap')
     def add_queue(self, task):
-        self.onQueue.emit(task)
-
+        self.onAddQueue.emit(task)
 
-    onLog = pyqtSignal(int, str)
 
     @pyqtSlot(str)
     def info(self, message):
-        self.onLog.emit(INFO, message)
+        self.log_event.emit(INFO, message, 'javascript')
 
     @pyqtSlot(str)
     def debug(self, message):
-        self.onLog.emit(DEBUG, message)
+        self.log_event.emit(DEBUG, message, 'javascript')
 
     @pyqtSlot(str)
     def error(self, message):
-        self.onLog.emit(ERROR, message)
+        self.log_event.emit(ERROR, message, 'javascript')
 
     @pyqtSlot(str)
     def warn(self, message):
-        self.onLog.emit(WARNING, message)
-
-
-    def __init__(self):
-        super(Proxy, self).__init__()
-        self._delay_timer = QTimer()
+        self.log_event.emit(WARNING, message, 'javascript')
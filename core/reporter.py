@@ -1,21 +1,28 @@
+import atexit
+import gzip
 import os
+import shutil
+import socket
 import sys
-from collections import OrderedDict
+from collections import deque
 from email.mime.text import MIMEText
-try:
-    # python2.6 support
-    from simplejson import load as json_load
-except ImportError:
-    from json import load as json_load
-from logging import getLogger, DEBUG, INFO, WARNING, ERROR
+from itertools import count
+from logging import getLogger, Handler, DEBUG, INFO, WARNING, ERROR
 from logging.handlers import RotatingFileHandler, SysLogHandler
 try:
     from logging.handlers import StreamHandler
 except ImportError:
     from logging import StreamHandler
-from smtplib import SMTP
+try:
+    from queue import Full, Queue
+except ImportError:
+    from Queue import Full, Queue
+from smtplib import SMTP, SMTPException
+from threading import Thread
+from time import time
 
-from core.helpers import flatten_settings_definition
+from core.helpers import get_base_dir, load_settings_definition
+from core.helpers import make_dirs
 
 def str_to_log_level(log_level):
     if log_level == 'debug':
@@ -43,23 +50,147 @@ def log_level_to_str(log_level):
         return 'UNKNOWN_%s' % log_level
 
 
+def gzip_namer(name):
+    return name + '.gz'
+
+
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in:
+        with gzip.open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+class AsyncHandler(Handler):
+    """
+    Hands the records over to a writer thread, the output handlers of every
+    logger (file rotation included) run there instead of in the Qt event
+    loop. When the queue is full debug and info records were dropped, the
+    others wait for room.
+    """
+    dropped = 0
+    _handlers = None
+    _queue = None
+    _thread = None
+
+    def __init__(self, queue_size):
+        Handler.__init__(self)
+        self._handlers = {}
+        self._queue = Queue(queue_size)
+        self._thread = Thread(target=self._run, name='reporter')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def add_handler(self, logname, handler):
+        self._handlers.setdefault(logname, []).append(handler)
+
+
+    def emit(self, record):
+        if record.levelno >= WARNING:
+            self._queue.put(record)
+            return
+        try:
+            self._queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+
+            for handler in self._handlers.get(record.name, ()):
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+    def close(self):
+        """ Write the queued records and stop the writer thread """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+        for handlers in self._handlers.values():
+            for handler in handlers:
+                handler.close()
+        Handler.close(self)
+
+
+def send_mail(settings, body, subject=None):
+    """ Raises the smtplib and socket errors, eg. on timeout """
+    msg = MIMEText(body)
+    msg['Subject'] = subject or settings['reporter.email.content.subject']
+    msg['From'] = settings['reporter.email.content.from']
+    msg['To'] = settings['reporter.email.content.to']
+
+    sender = SMTP(host=settings['reporter.email.sender.host'],
+            port=int(settings['reporter.email.sender.port']),
+            timeout=float(settings['reporter.email.sender.timeout']))
+
+    try:
+        if int(settings['reporter.email.sender.use_tls']):
+            sender.starttls()
+
+        if settings['reporter.email.sender.username']:
+            sender.login(user=settings['reporter.email.sender.username'],
+                    password=settings['reporter.email.sender.password'])
+
+        sender.sendmail(from_addr=msg['From'], msg=msg.as_string(),
+                to_addrs=[to.strip() for to in msg['To'].split(',')])
+    finally:
+        try:
+            sender.quit()
+        except (SMTPException, socket.error):
+            sender.close()
+
+
 class MailReporter(object):
+    """
+    Mails the log lines of a run which had an error. Every log keeps only its
+    latest `reporter.email.max_lines` lines, the number of dropped ones is
+    summarized instead. The mail is sent from a daemon thread, the exit
+    doesn't wait for it longer than the smtp timeout.
+
+    With a digest directory the reports were spooled there. At the end of
+    every run, with or without an error, the reports of many runs were
+    mailed together once the oldest is `digest.interval` seconds old.
+    """
+    # machine readable logs, not worth mailing
+    ignored_logs = ('metrics',)
+    name = ''
     settings = None
+    _counter = None
+    _dropped = None
     _logs = None
     _log_level = None
     _log_level_send = None
+    _max_lines = 0
     _send = None
+    _thread = None
 
-    def __init__(self, settings):
+    def __init__(self, settings, name=''):
+        self.name = name
         self.settings = settings
 
-        self._logs = []
+        self._counter = count()
+        self._dropped = {}
+        self._logs = {}
+        self._max_lines = int(settings['reporter.email.max_lines'])
         self._send = False
         self._log_level = str_to_log_level(settings['reporter.email.log_level'])
         self._log_level_send = str_to_log_level(
                 settings['reporter.email.log_level_send'])
 
 
+    @property
+    def log_level(self):
+        """ Lowest level of the messages the report needs """
+        return min(self._log_level, self._log_level_send)
+
+
     def attach(self, thingy):
         if int(self.settings['reporter.email.enabled']) == 0:
             return
@@ -71,50 +202,159 @@ class MailReporter(object):
 
 
     def _on_log(self, log_level, message, group):
+        group = str(group)
+        if group in self.ignored_logs:
+            return
         if log_level >= self._log_level_send:
             self._send = True
-        if log_level >= self._log_level:
-            self._logs.append((str(group), log_level, str(message)))
+        if log_level < self._log_level:
+            return
+
+        lines = self._logs.get(group)
+        if lines is None:
+            lines = self._logs[group] = deque(maxlen=self._max_lines or None)
+        if lines.maxlen and len(lines) == lines.maxlen:
+            self._dropped[group] = self._dropped.get(group, 0) + 1
+        lines.append((next(self._counter), group, log_level, str(message)))
 
 
     def _generate_content(self):
-        for group, log_level, text in self._logs:
+        for group, dropped in sorted(self._dropped.items()):
+            yield '%d earlier lines of the %s log were dropped.' % (dropped,
+                    group)
+
+        lines = sorted(line for group in self._logs.values() \
+                for line in group)
+
+        for seq, group, log_level, text in lines:
             yield '%s: %s: %s' % (log_level_to_str(log_level), group, text)
 
 
     def _on_app_quit(self):
-        if not self._send:
+        digest = bool(self.settings['reporter.email.digest.directory'])
+        if not self._send and not digest:
             return
 
-        msg = MIMEText('\n'.join(self._generate_content()))
-        msg['Subject'] = self.settings['reporter.email.content.subject']
-        msg['From'] = self.settings['reporter.email.content.from']
-        msg['To'] = self.settings['reporter.email.content.to']
+        body = None
+        if self._send:
+            body = '\n'.join(self._generate_content())
+        self._logs = {}
+        self._dropped = {}
+        self._send = False
 
-        sender = SMTP(host=self.settings['reporter.email.sender.host'],
-                port=int(self.settings['reporter.email.sender.port']))
+        self._thread = Thread(target=self._deliver, args=(body,),
+                name='mailer')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def wait(self, timeout=None):
+        """ Block until the mail was delivered, given up or `timeout` """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+    def close(self):
+        """ The exit isn't held longer than a single smtp operation """
+        if self._thread is not None:
+            timeout = float(self.settings['reporter.email.sender.timeout'])
+            self.wait(timeout)
+            if not self._thread.is_alive():
+                return
+            if self.settings['reporter.email.digest.directory']:
+                # a stale digest lock expires with the interval
+                sys.stderr.write('The digest was not mailed within %gs, ' \
+                        'the reports stay spooled.\n' % timeout)
+            else:
+                sys.stderr.write('The report was not mailed within %gs, ' \
+                        'it is lost.\n' % timeout)
+
+
+    def _deliver(self, body):
+        """ `body` is None if only the spooled reports may be mailed """
+        directory = self.settings['reporter.email.digest.directory']
+        try:
+            if directory:
+                self._spool(directory, body)
+            elif body is not None:
+                send_mail(self.settings, body)
+        except (EnvironmentError, SMTPException) as e:
+            sys.stderr.write('Cannot mail the report: %s\n' % e)
+
+
+    def _spool(self, directory, body):
+        if not os.path.isabs(directory):
+            directory = os.path.join(get_base_dir(), directory)
+        make_dirs(directory)
+
+        if body is not None:
+            filename = os.path.join(directory, '%d-%d-%s.txt' % (time(),
+                    os.getpid(), self.name))
+
+            with open(filename + '.tmp', 'w') as f:
+                f.write(body)
+            os.rename(filename + '.tmp', filename)
+
+        filenames = sorted(x for x in os.listdir(directory) \
+                if x.endswith('.txt'))
+        if not filenames:
+            return
 
-        if int(self.settings['reporter.email.sender.use_tls']):
-            sender.starttls()
+        interval = int(self.settings['reporter.email.digest.interval'])
+        oldest = os.path.getmtime(os.path.join(directory, filenames[0]))
+        if time() - oldest < interval:
+            return
 
-        if self.settings['reporter.email.sender.username']:
-            sender.login(user=self.settings['reporter.email.sender.username'],
-                    password=self.settings['reporter.email.sender.password'])
+        # a single process sends the digest, the lock of a crashed one
+        # expires with the interval
+        lock = os.path.join(directory, 'digest.lock')
+        if os.path.exists(lock) and time() - os.path.getmtime(lock) > \
+                interval:
 
-        sender.sendmail(from_addr=msg['From'], msg=msg.as_string(),
-                to_addrs=[to.strip() for to in msg['To'].split(',')])
+            os.remove(lock)
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL))
+        except OSError:
+            return
+
+        try:
+            reports = []
+            for filename in filenames:
+                with open(os.path.join(directory, filename)) as f:
+                    reports.append('== %s ==\n%s' % (filename[:-4], f.read()))
+
+            subject = '%s (digest of %d reports)' % (
+                    self.settings['reporter.email.content.subject'],
+                    len(reports))
+
+            send_mail(self.settings, '\n\n'.join(reports), subject)
 
-        sender.quit()
+            for filename in filenames:
+                os.remove(os.path.join(directory, filename))
+        finally:
+            os.remove(lock)
 
 
 class Reporter(object):
+    """
+    Loggers of the known logs. A logger's level is the lowest of its output
+    and the mail report, so `Application.is_logging` is True only if a
+    message would be kept somewhere.
+    """
+    _closed = False
     _mailer = None
+    _writer = None
     settings = None
-    known_logs = ('default', 'http', 'javascript', 'qt')
+    known_logs = ('default', 'http', 'javascript', 'metrics', 'qt')
 
     def __init__(self, name, settings):
         self.settings = settings
-        self._mailer = MailReporter(settings)
+        self._mailer = MailReporter(settings, name)
+        self._writer = AsyncHandler(int(
+                settings['reporter.writer.queue_size']))
+
+        compress = int(settings['reporter.writer.compress'])
+        mail_enabled = int(settings['reporter.email.enabled'])
 
         base_dir = os.path.dirname(os.path.dirname(
                 os.path.realpath(__file__)))
@@ -123,12 +363,18 @@ class Reporter(object):
 
         for logname in self.known_logs:
             log = getLogger(logname)
-            log.setLevel(str_to_log_level(
-                settings['reporter.%s.log_level' % logname]))
+            log_level = str_to_log_level(
+                settings['reporter.%s.log_level' % logname])
+
+            if mail_enabled and not logname in self._mailer.ignored_logs:
+                log.setLevel(min(log_level, self._mailer.log_level))
+            else:
+                log.setLevel(log_level)
 
+            handler = None
             output_type = settings['reporter.%s.type' % logname]
             if output_type == 'syslog':
-                log.addHandler(SysLogHandler(address='/dev/log'))
+                handler = SysLogHandler(address='/dev/log')
 
             elif output_type == 'file':
                 filename = settings['reporter.%s.filename' % logname]
@@ -143,11 +389,23 @@ class Reporter(object):
                 if filecount > 0:
                     filecount -= 1
 
-                log.addHandler(RotatingFileHandler(filename,
-                        maxBytes=filesize, backupCount=filecount))
+                handler = RotatingFileHandler(filename, maxBytes=filesize,
+                        backupCount=filecount)
+
+                if compress:
+                    # python 3.3+, older ones rotate uncompressed
+                    handler.namer = gzip_namer
+                    handler.rotator = gzip_rotator
 
             elif output_type == 'console':
-                log.addHandler(StreamHandler())
+                handler = StreamHandler()
+
+            if handler is not None:
+                handler.setLevel(log_level)
+                self._writer.add_handler(logname, handler)
+                log.addHandler(self._writer)
+
+        atexit.register(self.close)
 
 
     def attach(self, thingy):
@@ -155,6 +413,18 @@ class Reporter(object):
         self._mailer.attach(thingy)
 
 
+    def close(self):
+        if self._closed:
+            return
+
+        self._closed = True
+        self._mailer.close()
+        self._writer.close()
+        if self._writer.dropped:
+            sys.stderr.write('%d log records were dropped, the writer ' \
+                    'could not keep up.\n' % self._writer.dropped)
+
+
     def _on_log(self, log_level, message, group):
         group = str(group)
         if group in self.known_logs:
@@ -166,10 +436,5 @@ class Reporter(object):
 
 
 def get_settings_definition():
-    settings_filename = os.path.join(os.path.dirname(__file__),
-            'reporter_settings.json')
-
-    with open(settings_filename) as f:
-        settings = json_load(f, object_pairs_hook=OrderedDict)
-
-    return flatten_settings_definition(settings)
+    return load_settings_definition(os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'reporter_settings.json'))
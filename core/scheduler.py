@@ -0,0 +1,133 @@
+""" Tasks waiting for an idle page """
+
+import heapq
+from itertools import count
+try:
+    from time import monotonic as timer
+except ImportError:
+    from time import time as timer
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+
+def get_task_host(task):
+    return urlsplit(task.get('goto') or '').netloc.lower()
+
+
+class Scheduler(object):
+    """
+    Queue of tasks ordered by their `priority` (higher first, then in the
+    order they were added), tasks with a `delay` (seconds) wait before they
+    can be started.
+
+    Tasks of the same host were limited to `host_concurrency` running at
+    once (0 for no limit), started at least `host_interval` seconds apart.
+    Nothing here blocks, the application asks again after `wait_time()`.
+    """
+    host_concurrency = 0
+    host_interval = 0.0
+
+    def __init__(self, host_concurrency=0, host_interval=0.0):
+        self.host_concurrency = host_concurrency
+        self.host_interval = host_interval
+
+        self._counter = count()
+        # (not_before, seq, task_id, task)
+        self._delayed = []
+        # (-priority, seq, task_id, task)
+        self._ready = []
+        self._host_active = {}
+        self._host_started = {}
+
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(int(settings['application.scheduler.host_concurrency']),
+                int(settings['application.scheduler.host_interval']) / 1000.0)
+
+
+    def __len__(self):
+        return len(self._delayed) + len(self._ready)
+
+
+    def put(self, task, task_id=None):
+        seq = next(self._counter)
+        delay = float(task.get('delay') or 0)
+        if delay > 0:
+            heapq.heappush(self._delayed, (timer() + delay, seq, task_id,
+                    task))
+        else:
+            heapq.heappush(self._ready, (-int(task.get('priority') or 0), seq,
+                    task_id, task))
+
+
+    def get(self):
+        """ `(task_id, task)` that can be started now, or None """
+        now = timer()
+        while self._delayed and self._delayed[0][0] <= now:
+            not_before, seq, task_id, task = heapq.heappop(self._delayed)
+            heapq.heappush(self._ready, (-int(task.get('priority') or 0), seq,
+                    task_id, task))
+
+        skipped = []
+        result = None
+        while self._ready:
+            item = heapq.heappop(self._ready)
+            host = get_task_host(item[3])
+            if self._host_wait_time(host, now) != 0:
+                skipped.append(item)
+                continue
+
+            self._host_active[host] = self._host_active.get(host, 0) + 1
+            self._host_started[host] = now
+            result = item[2], item[3]
+            break
+
+        for item in skipped:
+            heapq.heappush(self._ready, item)
+        return result
+
+
+    def done(self, task):
+        """ A task returned by `get()` has finished """
+        host = get_task_host(task)
+        active = self._host_active.get(host, 0) - 1
+        if active > 0:
+            self._host_active[host] = active
+        else:
+            self._host_active.pop(host, None)
+
+
+    def wait_time(self):
+        """
+        Seconds before another task could be started, None if there is
+        nothing to wait for.
+        """
+        now = timer()
+        result = None
+        if self._delayed:
+            result = max(0.0, self._delayed[0][0] - now)
+
+        for item in self._ready:
+            wait_time = self._host_wait_time(get_task_host(item[3]), now)
+            if wait_time is None:
+                # waits for a running task of the host to finish
+                continue
+            if result is None or wait_time < result:
+                result = wait_time
+        return result
+
+
+    def _host_wait_time(self, host, now):
+        """ 0 if the host can have a task started, None if it is full """
+        if self.host_concurrency and \
+                self._host_active.get(host, 0) >= self.host_concurrency:
+
+            return None
+
+        started = self._host_started.get(host)
+        if self.host_interval and started is not None:
+            return max(0.0, started + self.host_interval - now)
+        return 0.0
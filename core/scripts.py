@@ -0,0 +1,74 @@
+""" Javascript helpers installed in the frames handlers work on """
+
+import os
+from collections import OrderedDict
+from hashlib import sha1
+from json import dumps as json_dumps
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(__file__), 'js')
+
+INSTALLED_JS_SOURCE = "window.__botScripts == %s"
+
+BUNDLE_JS_SOURCE = """
+    (function() {
+        %s
+    })();
+    window.__botScripts = %s;
+"""
+
+
+class ScriptLibrary(object):
+    """
+    Named script sources read once. The combined bundle is evaluated in a
+    frame only if the frame doesn't have this version of it already, so
+    frames without handlers (eg. ads) never parse it.
+    """
+    _bundle = None
+    _scripts = None
+    _version = None
+
+    def __init__(self):
+        self._scripts = OrderedDict()
+
+
+    def add(self, name, source):
+        """ Add or replace a script, the bundle is rebuilt on next install """
+        self._scripts[name] = source
+        self._bundle = None
+
+
+    def add_file(self, name, filename):
+        if not os.path.isabs(filename):
+            filename = os.path.join(SCRIPTS_DIR, filename)
+
+        with open(filename) as f:
+            self.add(name, f.read())
+
+
+    def _build(self):
+        digest = sha1()
+        for name, source in self._scripts.items():
+            digest.update(name.encode('utf-8'))
+            digest.update(source.encode('utf-8'))
+
+        self._version = json_dumps(digest.hexdigest()[:12])
+        self._bundle = BUNDLE_JS_SOURCE % ('\n'.join(
+                self._scripts.values()), self._version)
+
+
+    def install(self, frame):
+        """ Returns True if the bundle had to be evaluated """
+        if self._bundle is None:
+            self._build()
+
+        result = frame.evaluateJavaScript(INSTALLED_JS_SOURCE % \
+                self._version)
+
+        if hasattr(result, 'toBool'):
+            # PyQt4 QVariant
+            result = result.toBool()
+        if result:
+            return False
+
+        frame.evaluateJavaScript(self._bundle)
+        return True
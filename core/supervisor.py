@@ -0,0 +1,221 @@
+""" Run jobs in worker processes, each with its own headless display """
+
+import os
+import sys
+from logging import DEBUG, ERROR, INFO, WARNING
+from multiprocessing import Process, Queue
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+try:
+    from PyQt5.QtCore import QObject, pyqtSignal
+except ImportError:
+    from PyQt4.QtCore import QObject, pyqtSignal
+
+# exit codes of a python process that died with an uncaught exception
+CRASH_EXIT_CODES = (1,)
+
+
+class LogForwarder(object):
+    """
+    Attached to the worker's `Application` instead of a `Reporter`, sends
+    log events to the supervisor process.
+    """
+    def __init__(self, log_queue, worker_id):
+        self._log_queue = log_queue
+        self._worker_id = worker_id
+
+
+    def attach(self, thingy):
+        thingy.log_event.connect(self._on_log)
+
+
+    def _on_log(self, log_level, message, group):
+        self._log_queue.put((log_level, '#%d: %s' % (self._worker_id, message),
+                str(group)))
+
+
+def _run_worker(target, settings, display, log_queue, worker_id):
+    if display:
+        os.environ['DISPLAY'] = display
+    sys.exit(target(settings, LogForwarder(log_queue, worker_id)))
+
+
+class Worker(object):
+    display = None
+    job = None
+    process = None
+    retries = 0
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+
+
+class Supervisor(QObject):
+    """
+    Feeds jobs, settings overrides for a single run of a task, to a number of
+    worker processes. Crashed workers were restarted with the same job.
+    """
+    _jobs = None
+    _log_queue = None
+    _return_code = 0
+    _stopping = False
+    _workers = None
+
+    aboutToQuit = pyqtSignal()
+    log_event = pyqtSignal(int, str, str)
+
+    def __init__(self, settings, target, workers=1):
+        """
+        `target` is called in the worker process with the job's settings and
+        a log reporter to attach, and returns the exit code.
+        """
+        super(Supervisor, self).__init__()
+
+        self.settings = settings
+        self.target = target
+
+        self._jobs = []
+        self._log_queue = Queue()
+        self._retries = int(settings['application.supervisor.retries'])
+        self._workers = [Worker(ii) for ii in range(max(1, workers))]
+
+
+    def add_job(self, job=None):
+        self._jobs.append(job or {})
+
+
+    def start(self):
+        self._start_displays()
+        try:
+            while not self._stopping and (self._jobs or \
+                    any(w.job is not None for w in self._workers)):
+
+                self._spawn_workers()
+                self._read_logs(0.2)
+                self._reap_workers()
+        finally:
+            # workers can't exit before their queued logs were read
+            while any(w.process is not None and w.process.is_alive() \
+                    for w in self._workers):
+
+                self._read_logs(0.2)
+            self._read_logs(0)
+            self._stop_displays()
+
+        self.log_event.emit(INFO, 'Supervisor finished with code %d.' % \
+                self._return_code, 'default')
+
+        self.aboutToQuit.emit()
+        return self._return_code
+
+
+    def stop(self):
+        self._stopping = True
+        self._return_code = -1
+        for worker in self._workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+
+
+    def _start_displays(self):
+        if int(self.settings['application.visible']):
+            return
+
+        try:
+            from pyvirtualdisplay import Display
+        except ImportError:
+            self.log_event.emit(WARNING, 'pyvirtualdisplay is not ' +\
+                    'installed, workers share the current display.',
+                    'default')
+            return
+
+        for worker in self._workers:
+            worker.display = Display(visible=0)
+            worker.display.start()
+
+        # Display.start() also changed our own environment
+        if 'DISPLAY' in os.environ:
+            del os.environ['DISPLAY']
+
+
+    def _stop_displays(self):
+        for worker in self._workers:
+            if worker.display is not None:
+                worker.display.stop()
+                worker.display = None
+
+
+    def _spawn_workers(self):
+        for worker in self._workers:
+            if worker.process is not None:
+                continue
+
+            if worker.job is None:
+                if not self._jobs:
+                    continue
+                worker.job = self._jobs.pop(0)
+                worker.retries = 0
+
+            settings = dict(self.settings)
+            settings.update(worker.job)
+
+            display = None
+            if worker.display is not None:
+                display = ':%s' % worker.display.display
+
+            worker.process = Process(target=_run_worker, args=(self.target,
+                    settings, display, self._log_queue, worker.worker_id))
+
+            worker.process.start()
+            self.log_event.emit(DEBUG, 'Worker #%d started, pid %s.' % (
+                    worker.worker_id, worker.process.pid), 'default')
+
+
+    def _read_logs(self, timeout):
+        while True:
+            try:
+                if timeout:
+                    log_level, message, group = self._log_queue.get(
+                            timeout=timeout)
+                    timeout = 0
+                else:
+                    log_level, message, group = self._log_queue.get_nowait()
+            except Empty:
+                return
+            self.log_event.emit(log_level, message, group)
+
+
+    def _reap_workers(self):
+        for worker in self._workers:
+            process = worker.process
+            if process is None or process.is_alive():
+                continue
+
+            process.join()
+            worker.process = None
+            exit_code = process.exitcode
+
+            crashed = exit_code < 0 or exit_code in CRASH_EXIT_CODES
+            if crashed and not self._stopping and \
+                    worker.retries < self._retries:
+
+                worker.retries += 1
+                self.log_event.emit(WARNING, 'Worker #%d crashed with code ' \
+                        '%d, restarting (%d/%d).' % (worker.worker_id,
+                        exit_code, worker.retries, self._retries), 'default')
+
+                # the worker will be spawned again with the same job
+                continue
+
+            if exit_code != 0:
+                self.log_event.emit(ERROR, 'Worker #%d exited with code %d.' \
+                        % (worker.worker_id, exit_code), 'default')
+
+                self._return_code = -1
+            else:
+                self.log_event.emit(DEBUG, 'Worker #%d finished its job.' % \
+                        worker.worker_id, 'default')
+
+            worker.job = None
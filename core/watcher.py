@@ -0,0 +1,80 @@
+""" Bridge between page javascript and the expectations engine """
+
+try:
+    from PyQt5.QtCore import QObject, pyqtSignal, pyqtSlot
+except ImportError:
+    from PyQt4.QtCore import QObject, pyqtSignal, pyqtSlot
+
+WATCHER_JS_NAME = 'botWatcher'
+
+WATCHER_JS_SOURCE = """
+    (function(frameName) {
+        if (window.__botWatching) {
+            return true;
+        }
+        if (!window.%(name)s) {
+            return false;
+        }
+        window.__botWatching = true;
+
+        var pending = false;
+        var notify = function() {
+            if (pending) {
+                return;
+            }
+            pending = true;
+            setTimeout(function() {
+                pending = false;
+                %(name)s.notify(frameName);
+            }, 0);
+        };
+
+        var Observer = window.MutationObserver ||
+                window.WebKitMutationObserver;
+
+        if (Observer) {
+            new Observer(notify).observe(document, {
+                attributes: true,
+                characterData: true,
+                childList: true,
+                subtree: true,
+            });
+        }
+        else {
+            document.addEventListener('DOMSubtreeModified', notify, false);
+        }
+        window.addEventListener('hashchange', notify, false);
+        return true;
+    })('%%s');
+""" % {'name': WATCHER_JS_NAME}
+
+
+class DomWatcher(QObject):
+    """
+    Receives DOM mutation notifications from the observer script injected into
+    every frame, the frame is identified by its object name.
+    """
+    mutated = pyqtSignal(str)
+
+    @pyqtSlot(str)
+    def notify(self, frame_name):
+        self.mutated.emit(frame_name)
+
+
+    def install(self, frame):
+        """ Called when the javascript `window` object of a frame was reset """
+        frame.addToJavaScriptWindowObject(WATCHER_JS_NAME, self)
+
+
+    def observe(self, frame):
+        """
+        Start observing a loaded frame's document, returns False if the bridge
+        object wasn't available in the frame.
+        """
+        result = frame.evaluateJavaScript(WATCHER_JS_SOURCE % \
+                str(frame.objectName()))
+
+        if hasattr(result, 'toBool'):
+            # PyQt4 QVariant
+            result = result.toBool()
+        return bool(result)
@@ -1,4 +1,4 @@
-from logging import DEBUG, ERROR, INFO, WARNING
+from logging import getLogger, DEBUG, ERROR, INFO, WARNING
 try:
     from PyQt5.QtCore import pyqtSignal
     from PyQt5.QtWebKitWidgets import QWebPage
@@ -56,6 +56,8 @@ class WebPage(QWebPage):
 
 
     def javaScriptConsoleMessage(self, message, lineNumber, sourceID):
+        if not getLogger('javascript').isEnabledFor(DEBUG):
+            return
         self.log_event.emit(DEBUG, 'Log:%s:%s: %s' % (sourceID,
                 lineNumber, message), 'javascript')
 
@@ -0,0 +1,113 @@
+""" Fork-server starting jobs from an already initialized process """
+
+import os
+import signal
+import socket
+import sys
+import traceback
+from json import dumps as json_dumps, loads as json_loads
+
+
+def serve(path, run_job):
+    """
+    Accept jobs on a UNIX socket, one JSON object per connection, each of
+    them runs in a forked child as `run_job(job, connection)` which returns
+    the exit code. Nothing here may start a thread or a Qt object, they
+    don't survive the fork.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(16)
+
+    # the children run the handlers of the application
+    handlers = dict((signum, signal.getsignal(signum)) for signum in \
+            (signal.SIGINT, signal.SIGTERM))
+
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, _raise_exit)
+    # nobody waits for the children
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    sys.stderr.write('Zygote listening on %s.\n' % path)
+    try:
+        while True:
+            connection = server.accept()[0]
+            try:
+                job = json_loads(_read_line(connection) or '{}')
+            except ValueError as e:
+                _send(connection, 'error %s' % e)
+                connection.close()
+                continue
+
+            if os.fork() == 0:
+                server.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                for signum, handler in handlers.items():
+                    signal.signal(signum, handler)
+
+                return_code = -1
+                try:
+                    return_code = run_job(job, connection)
+                except SystemExit as e:
+                    return_code = e.code or 0
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    try:
+                        _send(connection, 'exit %d' % return_code)
+                        connection.close()
+                    finally:
+                        os._exit(return_code & 0xff)
+
+            connection.close()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.close()
+        os.remove(path)
+    return 0
+
+
+def submit(path, job):
+    """ Run a job in a zygote, returns its exit code """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(path)
+    _send(connection, json_dumps(job))
+
+    return_code = -1
+    for line in connection.makefile('r'):
+        line = line.strip()
+        if line.startswith('exit '):
+            return_code = int(line[5:])
+        elif line.startswith('error '):
+            sys.stderr.write('Zygote: %s\n' % line[6:])
+        else:
+            sys.stderr.write('Zygote: %s\n' % line)
+    connection.close()
+    return return_code
+
+
+def notify(connection, message):
+    """ Status line sent to the client of a job """
+    _send(connection, message)
+
+
+def _send(connection, line):
+    connection.sendall((line + '\n').encode('utf-8'))
+
+
+def _read_line(connection):
+    data = b''
+    while not data.endswith(b'\n'):
+        chunk = connection.recv(4096)
+        if not chunk:
+            break
+        data += chunk
+    return data.decode('utf-8').strip()
+
+
+def _raise_exit(signum, frame):
+    raise SystemExit(0)
@@ -1,37 +1,187 @@
+try:
+    from time import monotonic as timer
+except ImportError:
+    from time import time as timer
+# beginning of a cold start, before the heavy imports
+STARTED_AT = timer()
+
+import os
 import signal
 import sys
+from functools import partial
+from optparse import OptionParser
+try:
+    # python2.6 support
+    from simplejson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
-from core.application import Application
+from core.archive import NetworkArchive
+from core.helpers import disable_prompts, preload_settings_definitions
 from core.reporter import Reporter
+from tasks import get_task
 
 app = None
+supervisor = None
 settings = {}
 
 def signal_handler(signum, frame):
     if app:
         app.exit(-1)
+    if supervisor:
+        supervisor.stop()
 
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
 
+def run_application(task_name, settings, reporter, resume=False,
+        started_at=None, warm=False):
+
+    """ `started_at` is when the process (or its fork) began, if reported """
+    global app
+    from core.application import Application
+
+    collect_settings, build_queue = get_task(task_name)
+
+    #if not int(settings['application.visible']):
+    #    from pyvirtualdisplay import Display
+    #    display = Display(backend='xvfb')
+    #    display.start()
+
+    app = Application(task_name, settings)
+    reporter.attach(app)
+
+    if not resume or not app.resume():
+        app.reset_journal()
+        build_queue(app)
+
+    if started_at is not None:
+        app.info('Started in %.3fs (%s start).', timer() - started_at,
+                'warm' if warm else 'cold')
+    return app.start()
+
+
+def run_zygote_job(task_name, job, connection):
+    """ Runs in a child forked by the zygote """
+    from core.zygote import notify
+
+    forked_at = timer()
+    if job.get('task', task_name) != task_name:
+        notify(connection, 'error The zygote runs the task "%s".' % task_name)
+        return -1
+
+    os.environ.update(job.get('env') or {})
+    # a missing setting fails instead of waiting for an answer
+    disable_prompts()
+
+    collect_settings, build_queue = get_task(task_name)
+    job_settings = {}
+    try:
+        collect_settings(job_settings, job.get('settings'))
+    except EOFError:
+        notify(connection, 'error The job is missing some settings.')
+        return -1
+
+    reporter = Reporter(task_name, job_settings)
+    notify(connection, 'started %d' % os.getpid())
+    try:
+        return run_application(task_name, job_settings, reporter,
+                started_at=forked_at, warm=True)
+    finally:
+        reporter.close()
+
+
+def read_jobs(filename):
+    """ Jobs file has a JSON object of settings per line """
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json_loads(line)
+
+
 if __name__ == '__main__' and len(sys.argv) > 1:
-    if sys.argv[1] == 'ufbm':
-        from tasks.ufbm import collect_settings
-        from tasks.ufbm import unban_facebook_blocked_members
+    parser = OptionParser(usage='%prog [options] TASK')
+    parser.add_option('--workers', type='int', default=0,
+            help='run jobs in this many worker processes')
+    parser.add_option('--jobs', metavar='FILE',
+            help='settings of a job per line, used with --workers')
+    parser.add_option('--resume', action='store_true', default=False,
+            help='continue the unfinished tasks of the previous run')
+    parser.add_option('--zygote', metavar='SOCKET',
+            help='wait for jobs on a UNIX socket, each forked from this ' \
+            'process')
+    parser.add_option('--submit', metavar='SOCKET',
+            help='run the jobs in the zygote listening on a UNIX socket')
+
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Expected a single task name.')
+
+    task_name = args[0]
+    if options.submit:
+        from core.zygote import submit
+
+        # settings may come from the environment, like in a normal run
+        jobs = read_jobs(options.jobs) if options.jobs else [{}]
+        return_code = 0
+        for job in jobs:
+            return_code = submit(options.submit, {'task': task_name,
+                    'settings': job, 'env': dict(os.environ)}) or return_code
+        exit(return_code)
+
+    collect_settings, build_queue = get_task(task_name)
+    if collect_settings is None:
+        parser.error('Unknown task "%s".' % task_name)
+
+    if options.resume and options.workers > 0:
+        parser.error('--resume cannot be used with --workers.')
+
+    jobs = []
+    if options.workers > 0:
+        # a worker runs a whole job, a single one can't be spread
+        jobs = list(read_jobs(options.jobs)) if options.jobs else [{}]
+        if options.workers > 1 and len(jobs) < 2:
+            parser.error('--workers runs a job per worker, give more than ' \
+                    'one job with --jobs.')
+
+    if options.zygote:
+        from core.zygote import serve
+
+        # the expensive part of every job's start, done once
+        preload_settings_definitions()
+        sys.stderr.write('Zygote initialized in %.3fs.\n' % (
+                timer() - STARTED_AT))
+
+        exit(serve(options.zygote, partial(run_zygote_job, task_name)))
+
+    collect_settings(settings)
+    if options.resume and not settings['application.journal.filename']:
+        parser.error('--resume needs a journal, see ' \
+                'APPLICATION_JOURNAL_FILENAME.')
+
+    reporter = Reporter(task_name, settings)
+
+    # once, the workers add to the same recording
+    NetworkArchive.reset(settings, task_name)
+
+    if options.workers > 0:
+        from core.supervisor import Supervisor
+
+        # the workers would share the same journal
+        settings['application.journal.filename'] = ''
+        supervisor = Supervisor(settings, partial(run_application, task_name),
+                workers=min(options.workers, len(jobs)))
 
-        collect_settings(settings)
+        reporter.attach(supervisor)
 
-        #if not int(settings['application.visible']):
-        #    from pyvirtualdisplay import Display
-        #    display = Display(backend='xvfb')
-        #    display.start()
+        for job in jobs:
+            supervisor.add_job(job)
 
-        app = Application('ufbm', settings)
-        reporter = Reporter('ufbm', settings)
-        reporter.attach(app)
+        exit(supervisor.start())
 
-        unban_facebook_blocked_members(app)
-        exit(app.start())
+    exit(run_application(task_name, settings, reporter,
+            resume=options.resume, started_at=STARTED_AT))
 
 exit(-1)
@@ -1,14 +1,22 @@
 """ Facebook automation """
 
 import os
-from collections import OrderedDict
-try:
-    # python2.6 support
-    from simplejson import load as json_load
-except ImportError:
-    from json import load as json_load
 
-from core.helpers import flatten_settings_definition
+from core.helpers import load_settings_definition
+
+# cookies of a logged in facebook session
+SESSION_COOKIES = ('c_user', 'xs')
+
+
+def has_session(app):
+    """
+    Whether a saved session may still be logged in, the login task can be
+    skipped then.
+    """
+    if app.cookie_jar is None:
+        return False
+    return app.cookie_jar.has_cookies(app.settings['facebook.home'],
+            SESSION_COOKIES)
 
 
 def check_page_not_found(app, frame, *args):
@@ -31,7 +39,7 @@ def on_do_login_failed_trigger(app, frame):
     app.exit(-1)
 
 
-def on_do_login_trigger(app, frame):
+def on_do_login_trigger(app, frame, next_trigger='core.next_queue'):
     el_form = frame.documentElement().findFirst('form#login_form')
     if el_form.isNull():
         app.error("Cannot find Facebook's login form, UI has changed.")
@@ -67,7 +75,7 @@ def on_do_login_trigger(app, frame):
             'host': r'^www\.facebook\.com$',
             'path': r'^/$',
             'selector_exists': 'div[data-click="profile_icon"]',
-            'trigger': 'core.next_queue',
+            'trigger': next_trigger,
             'trigger_wait_pageload': True,
         },
         {
@@ -88,7 +96,7 @@ def on_do_login_trigger(app, frame):
     el_submit.evaluateJavaScript('bot.click(this)')
 
 
-def on_login_trigger(app, frame):
+def on_login_trigger(app, frame, next_trigger='core.next_queue'):
     app.add_handler('facebook.do_login', on_do_login_trigger)
 
     app.set_expects([
@@ -97,20 +105,52 @@ def on_login_trigger(app, frame):
             'path': r'^/$',
             'selector_exists': 'form#login_form',
             'trigger': 'facebook.do_login',
+            'trigger_args': {'next_trigger': next_trigger},
+        },
+        {
+            # the saved session is still logged in
+            'host': r'^www\.facebook\.com$',
+            'path': r'^/$',
+            'selector_exists': 'div[data-click="profile_icon"]',
+            'trigger': next_trigger,
         }])
 
 
+def on_relogin_trigger(app, frame):
+    """ The saved session has expired, log in and retry the active task """
+    app.info('Facebook session has expired, logging in.')
+
+    app.add_handler('facebook.login', on_login_trigger)
+
+    app.set_expects([
+        {
+            'host': r'^www\.facebook\.com$',
+            'path': r'^/$',
+            'trigger': 'facebook.login',
+            'trigger_args': {'next_trigger': 'core.retry_task'},
+            'trigger_wait_pageload': True,
+        }])
+
+    app.load(app.settings['facebook.home'])
+
+
+def get_session_expired_expects():
+    """ Expectations for tasks that may be redirected to the login page """
+    return [
+        {
+            'host': r'^www\.facebook\.com$',
+            'selector_exists': 'form#login_form',
+            'trigger': 'facebook.relogin',
+        }]
+
+
 def get_handlers():
     return (
         ('facebook.login', on_login_trigger),
+        ('facebook.relogin', on_relogin_trigger),
     )
 
 
 def get_settings_definition():
-    settings_filename = os.path.join(os.path.dirname(__file__),
-            'facebook_settings.json')
-
-    with open(settings_filename) as f:
-        settings = json_load(f, object_pairs_hook=OrderedDict)
-
-    return flatten_settings_definition(settings)
+    return load_settings_definition(os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'facebook_settings.json'))
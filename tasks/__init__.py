@@ -0,0 +1,9 @@
+def get_task(task_name):
+    """ Settings collector and queue builder of a task """
+    if task_name == 'ufbm':
+        from tasks.ufbm import collect_settings
+        from tasks.ufbm import unban_facebook_blocked_members
+
+        return collect_settings, unban_facebook_blocked_members
+
+    return None, None
@@ -1,15 +1,30 @@
 """ Unban Facebook Blocked Members """
 
+import os
+import re
+from collections import OrderedDict
 from itertools import chain
+try:
+    from time import monotonic as timer
+except ImportError:
+    from time import time as timer
+try:
+    from urllib.parse import parse_qsl, urlsplit
+except ImportError:
+    from urlparse import parse_qsl, urlsplit
 
 from core.application import get_settings_definition as application_settings
 from core.reporter import get_settings_definition as reporter_settings
+from core.extract import extract
 from core.helpers import evaluate_conditional, flatten_settings
+from core.helpers import load_settings_definition
 from core.helpers import get_settings_value, is_active_settings
 
 from modules.facebook import get_handlers as facebook_handlers
 from modules.facebook import get_settings_definition as facebook_settings
 from modules.facebook import check_page_not_found as facebook404
+from modules.facebook import get_session_expired_expects
+from modules.facebook import has_session as facebook_has_session
 
 ACTIVE_SETTINGS = (
     'application.',
@@ -18,8 +33,28 @@ ACTIVE_SETTINGS = (
     'facebook.username',
     'facebook.password',
     'facebook.forum.name',
+    'ufbm.',
 )
 
+# the token of the ajaxify attribute of the unban links, the endpoint it
+# posts to isn't relied upon
+REMOVE_BLOCK_XHR = r'[?&]action=remove_block(&|$)'
+SEE_MORE_XHR = r'/ajax/groups/blocked_more\.php'
+
+MEMBER_SELECTOR = '#pagelet_group_blocked div[id^="member_"]'
+MEMBER_NAME_SELECTOR = 'a.name'
+MEMBER_UNBAN_SELECTOR = '.adminActions > a[ajaxify*="action=remove_block"]'
+SEE_MORE_SELECTOR = '#pagelet_group_blocked a.uiMorePagerPrimary'
+
+# id and name of every listed member, see `core.extract`
+MEMBERS_SPEC = {
+    'rows': MEMBER_SELECTOR,
+    'fields': {
+        'id': {'attribute': 'id', 'regex': '^member_(.+)$'},
+        'name': MEMBER_NAME_SELECTOR,
+    },
+}
+
 def _get_urls(app):
     fb_forum = app.settings['facebook.forum.name']
     fb_home_url = app.settings['facebook.home']
@@ -51,7 +86,8 @@ def on_do_unban_timeout_trigger(app, frame):
 
 def on_do_empty_list_trigger(app, frame):
     app.info('No users were banned.')
-    app.exit(0)
+    # the other pages of the pool may still be working
+    app.trigger(frame, 'core.next_queue', {})
 
 
 def on_do_unban_confirm_trigger(app, frame):
@@ -59,6 +95,7 @@ def on_do_unban_confirm_trigger(app, frame):
 
     document = frame.documentElement()
 
+    # react when the remove block request returned, the page doesn't reload
     app.set_expects([
         {
             'host': r'^www\.facebook\.com$',
@@ -66,9 +103,30 @@ def on_do_unban_confirm_trigger(app, frame):
             'selector_exists': '#pagelet_group_blocked div[id^="member_"] ' +\
                     '.adminActions > a[ajaxify*="action=remove_block"]',
 
+            'selector_not_exists': 'button[name="remove_block"]',
+            'xhr_url': REMOVE_BLOCK_XHR,
+            'xhr_status': 200,
+            'trigger': 'ufbm.do_unban',
+        },
+        {
+            # the request went elsewhere and the page reloaded
+            'host': r'^www\.facebook\.com$',
+            'path': r'^%s?$' % urls['FORUM_BLOCKED_PATH'],
+            'selector_exists': '#pagelet_group_blocked div[id^="member_"] ' +\
+                    '.adminActions > a[ajaxify*="action=remove_block"]',
+
             'selector_not_exists': 'button[name="remove_block"]',
             'trigger': 'ufbm.do_unban',
             'trigger_wait_pageload': True,
+        },
+        {
+            'host': r'^www\.facebook\.com$',
+            'path': r'^%s?$' % urls['FORUM_BLOCKED_PATH'],
+            'selector_exists': '.fbProfileBrowserNullstate.' +\
+                    'fbProfileBrowserListContainer',
+
+            'xhr_url': REMOVE_BLOCK_XHR,
+            'trigger': 'ufbm.do_empty_list',
         }])
 
     app.add_handler('ufbm.do_unban_timeout', on_do_unban_timeout_trigger)
@@ -119,12 +177,289 @@ def on_do_unban_trigger(app, frame):
     el_unblock.evaluateJavaScript('bot.click(this)')
 
 
+class UnbanBatch(object):
+    """
+    Members of the blocked list unbanned in a single page visit, the next
+    member's confirm dialog is opened while the previous remove block
+    requests are still in flight.
+    """
+    app = None
+    concurrency = 1
+    interval = 0.0
+    timeout = 30.0
+
+    def __init__(self, app, concurrency, interval, timeout):
+        self.app = app
+        self.concurrency = max(1, concurrency)
+        self.interval = interval
+        self.timeout = timeout
+
+        self.confirmed_at = None
+        self.in_flight = OrderedDict()
+        self.links = {}
+        self.names = {}
+        self.pending = []
+        self.results = OrderedDict()
+
+
+    @classmethod
+    def from_settings(cls, app):
+        settings = app.settings
+        return cls(app, int(settings['ufbm.batch.concurrency']),
+                int(settings['ufbm.batch.interval']) / 1000.0,
+                float(settings['ufbm.batch.timeout']))
+
+
+    def collect(self, frame):
+        """ Queue the listed members which weren't seen before """
+        found = 0
+        for row in extract(frame, MEMBERS_SPEC):
+            member = row['id']
+            if member is None:
+                continue
+            if row['name']:
+                self.names[member] = row['name']
+            if member in self.results or member in self.in_flight or \
+                    member in self.pending:
+
+                continue
+            if self.app.is_done(self.done_key(member)):
+                # unbanned by an interrupted run, the list is stale
+                continue
+            self.pending.append(member)
+            found += 1
+        return found
+
+
+    def done_key(self, member):
+        return 'ufbm.%s.%s' % (self.app.settings['facebook.forum.name'],
+                member)
+
+
+    def clicked(self, member, ajaxify):
+        """ The remove block link of a member, its request is told apart
+        by the path and parameters of its ajaxify attribute """
+        parts = urlsplit(ajaxify)
+        self.links[member] = (parts.path, set(parse_qsl(parts.query)))
+
+
+    def find_member(self, url):
+        """
+        Member in flight a remove block request was sent for, None if the
+        url doesn't carry the parameters of its link. Such replies are
+        ignored, the member ends as timed out rather than being guessed.
+        """
+        parts = urlsplit(url)
+        query = set(parse_qsl(parts.query))
+        for member in self.in_flight:
+            path, params = self.links.get(member, (None, None))
+            if path is not None and parts.path.endswith(path) and \
+                    params <= query:
+
+                return member
+        return None
+
+
+    def confirmed(self, member):
+        self.confirmed_at = timer()
+        self.in_flight[member] = self.confirmed_at
+
+
+    def failed(self, member, reason):
+        self.in_flight.pop(member, None)
+        self.results[member] = (False, reason)
+
+
+    def has_capacity(self):
+        return len(self.in_flight) < self.concurrency
+
+
+    def wait_time(self):
+        """ Seconds before the next unban is allowed """
+        if self.confirmed_at is None:
+            return 0.0
+        return max(0.0, self.confirmed_at + self.interval - timer())
+
+
+    def has_expired(self, app, frame, *args):
+        """ `custom` expectation, some requests were waited for too long """
+        now = timer()
+        expired = [member for member, confirmed_at in self.in_flight.items() \
+                if now - confirmed_at > self.timeout]
+
+        for member in expired:
+            self.failed(member, 'timed out')
+        return bool(expired)
+
+
+    def has_more_members(self, app, frame, *args):
+        """ `custom` expectation, "see more" has been loaded """
+        document = frame.documentElement()
+        return self.collect(frame) > 0 or \
+                document.findFirst(SEE_MORE_SELECTOR).isNull()
+
+
+    def on_request_finished(self, frame_name, url, status):
+        if not re.search(REMOVE_BLOCK_XHR, str(url)):
+            return
+
+        member = self.find_member(str(url))
+        if member is None:
+            return
+
+        del self.in_flight[member]
+        if status == 200:
+            self.results[member] = (True, None)
+            self.app.mark_done(self.done_key(member))
+        else:
+            self.results[member] = (False, 'http status %d' % status)
+
+
+    def report(self, app):
+        failures = 0
+        for member, (success, reason) in self.results.items():
+            name = self.names.get(member, member)
+            if success:
+                app.info('Member %s has been unbanned.', name)
+            else:
+                failures += 1
+                app.warn('Member %s could not be unbanned: %s.', name, reason)
+
+        message = 'Unbanned %d of %d members.' % (
+                len(self.results) - failures, len(self.results))
+
+        if failures:
+            app.error(message)
+        else:
+            app.info(message)
+
+
+def _batch_expects(app, trigger, batch, **kwargs):
+    """ Expectation of the blocked list page with the batch state """
+    urls = _get_urls(app)
+
+    expect = {
+        'host': r'^www\.facebook\.com$',
+        'path': r'^%s?$' % urls['FORUM_BLOCKED_PATH'],
+        'trigger': trigger,
+        'trigger_args': {'batch': batch},
+    }
+    expect.update(kwargs)
+    return expect
+
+
+def on_batch_trigger(app, frame, batch=None):
+    """ Next step of the unban pipeline """
+    if batch is None:
+        batch = UnbanBatch.from_settings(app)
+        app.web_page.networkAccessManager().request_finished.connect(
+                batch.on_request_finished)
+
+        app.add_handler('ufbm.batch', on_batch_trigger)
+        app.add_handler('ufbm.batch_confirm', on_batch_confirm_trigger)
+        app.add_handler('ufbm.batch_dialog_timeout',
+                on_batch_dialog_timeout_trigger)
+
+    batch.has_expired(app, frame)
+    batch.collect(frame)
+
+    member = None
+    el_unblock = None
+    if batch.pending and batch.has_capacity():
+        wait_time = batch.wait_time()
+        if wait_time > 0:
+            # rate limited, the page can't be more ready than it is
+            app.set_expects(_batch_expects(app, 'ufbm.batch', batch,
+                    trigger_delay=wait_time, trigger_delay_mode='fixed'))
+
+            return
+
+        while batch.pending and el_unblock is None:
+            member = batch.pending.pop(0)
+            el_unblock = frame.documentElement().findFirst('#member_%s %s' % (
+                    member, MEMBER_UNBAN_SELECTOR))
+
+            if el_unblock.isNull():
+                batch.failed(member, 'remove block link not found')
+                el_unblock = None
+
+    if el_unblock is not None:
+        expect = _batch_expects(app, 'ufbm.batch_confirm', batch,
+                selector_exists='button[name="remove_block"]',
+                trigger_delay=5)
+
+        expect['trigger_args']['member'] = member
+        app.set_expects(expect)
+
+        # timeouts fire in the blocked list too, not in any frame
+        timeout_expect = _batch_expects(app, 'ufbm.batch_dialog_timeout',
+                batch)
+
+        timeout_expect['trigger_args']['member'] = member
+        app.set_timeout_expects(batch.timeout, timeout_expect)
+
+        batch.clicked(member, str(el_unblock.attribute('ajaxify')))
+        el_unblock.evaluateJavaScript('bot.click(this)')
+
+    elif batch.in_flight:
+        app.set_expects([
+                _batch_expects(app, 'ufbm.batch', batch,
+                        xhr_url=REMOVE_BLOCK_XHR),
+                _batch_expects(app, 'ufbm.batch', batch,
+                        custom=batch.has_expired)])
+
+        app.set_timeout_expects(batch.timeout,
+                _batch_expects(app, 'ufbm.batch', batch))
+
+    elif not frame.documentElement().findFirst(SEE_MORE_SELECTOR).isNull():
+        app.set_expects(_batch_expects(app, 'ufbm.batch', batch,
+                xhr_url=SEE_MORE_XHR, custom=batch.has_more_members))
+
+        app.set_timeout_expects(batch.timeout,
+                _batch_expects(app, 'ufbm.batch', batch))
+
+        frame.documentElement().findFirst(SEE_MORE_SELECTOR)\
+                .evaluateJavaScript('bot.click(this)')
+
+    else:
+        app.clear_timeout_expects()
+        app.web_page.networkAccessManager().request_finished.disconnect(
+                batch.on_request_finished)
+
+        batch.report(app)
+        app.trigger(frame, 'core.next_queue', {})
+
+
+def on_batch_confirm_trigger(app, frame, batch, member):
+    el_unblock = frame.documentElement().findFirst(
+            'button[name="remove_block"]')
+
+    if el_unblock.isNull():
+        batch.failed(member, 'confirm button not found')
+    else:
+        batch.confirmed(member)
+        el_unblock.evaluateJavaScript('bot.click(this)')
+
+    on_batch_trigger(app, frame, batch)
+
+
+def on_batch_dialog_timeout_trigger(app, frame, batch, member):
+    batch.failed(member, 'confirm dialog did not open')
+    on_batch_trigger(app, frame, batch)
+
+
 def on_unban_trigger(app, frame):
     urls = _get_urls(app)
 
     app.clear_handlers()
 
-    app.add_handler('ufbm.do_unban', on_do_unban_trigger)
+    if int(app.settings['ufbm.batch.enabled']):
+        unban_trigger = 'ufbm.batch'
+        app.add_handler('ufbm.batch', on_batch_trigger)
+    else:
+        unban_trigger = 'ufbm.do_unban'
+        app.add_handler('ufbm.do_unban', on_do_unban_trigger)
+
     app.add_handler('ufbm.do_empty_list', on_do_empty_list_trigger)
 
     app.set_expects([
@@ -134,7 +469,7 @@ def on_unban_trigger(app, frame):
             'selector_exists': '#pagelet_group_blocked div[id^="member_"] ' +\
                     '.adminActions > a[ajaxify*="action=remove_block"]',
 
-            'trigger': 'ufbm.do_unban',
+            'trigger': unban_trigger,
         },
         {
             'host': r'^www\.facebook\.com$',
@@ -149,21 +484,22 @@ def on_unban_trigger(app, frame):
 def unban_facebook_blocked_members(app):
     urls = _get_urls(app)
 
-    for name, callback in facebook_handlers():
+    for name, callback in get_handlers():
         app.add_handler(name, callback)
 
-    app.add_handler('ufbm.unban', on_unban_trigger)
-
-    app.add_queue(
-        {
-            'goto': app.settings['facebook.home'],
-            'expects': [
+    if facebook_has_session(app):
+        app.info('Reusing the saved Facebook session.')
+    else:
+        app.add_queue(
             {
-                'host': r'^www\.facebook\.com$',
-                'path': r'^/$',
-                'trigger': 'facebook.login',
-            }],
-        })
+                'goto': app.settings['facebook.home'],
+                'expects': [
+                {
+                    'host': r'^www\.facebook\.com$',
+                    'path': r'^/$',
+                    'trigger': 'facebook.login',
+                }],
+            })
 
     app.add_queue(
         {
@@ -180,15 +516,26 @@ def unban_facebook_blocked_members(app):
                 'path': r'^%s?$' % urls['FORUM_BLOCKED_PATH'],
                 'custom': facebook404,
                 'trigger': 'core.page_not_found',
-            }],
+            }] + get_session_expired_expects(),
         })
 
 
+def get_handlers():
+    return tuple(facebook_handlers()) + (
+        ('ufbm.unban', on_unban_trigger),
+    )
+
+
+def get_settings_definition():
+    return load_settings_definition(os.path.join(os.path.dirname(
+            os.path.realpath(__file__)), 'ufbm_settings.json'))
+
+
 def collect_settings(result, settings_in_file=None):
     primary_settings = dict(flatten_settings(settings_in_file or {}))
 
-    all_settings = chain(facebook_settings(), application_settings(),
-            reporter_settings())
+    all_settings = chain(get_settings_definition(), facebook_settings(),
+            application_settings(), reporter_settings())
 
     for name, config in all_settings:
         if 'default' in config: